@@ -0,0 +1,181 @@
+import os
+import random
+
+import search
+import tablebase
+from engine import CELLS, FULL, WINNING, MOVES, CLASSIC, get_available_moves, runs
+
+LEVELS = ('easy', 'normal', 'hard', 'perfect')
+DEFAULT_LEVEL = 'normal'
+
+# A position is always seen from the side to move: `me` is its mask, `opp` the
+# opponent's. key = T3[me] + 2 * T3[opp] is the base-3 number of the board.
+T3 = tuple(sum(3 ** i for i in range(CELLS) if mask >> i & 1) for mask in range(FULL + 1))
+POSITIONS = 3 ** CELLS
+
+def _cell_maps():
+    maps = []
+    for flip in (False, True):
+        for turns in range(4):
+            cells = []
+            for i in range(CELLS):
+                row, col = divmod(i, 3)
+                if flip:
+                    col = 2 - col
+                for _ in range(turns):
+                    row, col = col, 2 - row
+                cells.append(row * 3 + col)
+            maps.append(cells)
+    return maps
+
+# SYM[t][mask] is the mask after applying the t-th of the 8 board symmetries.
+SYM = tuple(
+    tuple(sum(1 << cells[i] for i in range(CELLS) if mask >> i & 1) for mask in range(FULL + 1))
+    for cells in _cell_maps()
+)
+
+def position_key(me, opp):
+    return T3[me] + 2 * T3[opp]
+
+def canonical_key(me, opp):
+    return min(T3[sym[me]] + 2 * T3[sym[opp]] for sym in SYM)
+
+def solve():
+    # Negamax over every reachable position; values are +1/0/-1 for the side to move.
+    values = {}
+
+    def negamax(me, opp):
+        key = canonical_key(me, opp)
+        value = values.get(key)
+        if value is not None:
+            return value
+        if WINNING[opp]:
+            value = -1
+        elif me | opp == FULL:
+            value = 0
+        else:
+            value = max(-negamax(opp, me | 1 << (move - 1)) for move in MOVES[FULL & ~(me | opp)])
+        values[key] = value
+        return value
+
+    negamax(0, 0)
+    return values
+
+def build_records():
+    # One tablebase record per position_key(); see tablebase.py for the layout.
+    values = solve()
+    records = [0] * POSITIONS
+
+    def expand(me, opp):
+        key = position_key(me, opp)
+        if records[key]:
+            return
+        value = values[canonical_key(me, opp)]
+        if WINNING[opp] or me | opp == FULL:
+            records[key] = tablebase.pack_record(0, value)
+            return
+        moves = MOVES[FULL & ~(me | opp)]
+        scores = [-values[canonical_key(opp, me | 1 << (move - 1))] for move in moves]
+        best = max(scores)
+        records[key] = tablebase.pack_record(sum(1 << (move - 1) for move, score in zip(moves, scores) if score == best),
+                                             value)
+        for move in moves:
+            expand(opp, me | 1 << (move - 1))
+
+    expand(0, 0)
+    return records
+
+# The mapped tablebase; set by load_tables().
+TABLE = None
+
+def load_tables(path=tablebase.PATH):
+    # Maps the file written by tablebase.py. Workers forked after this call
+    # share the mapping; if the file is missing it is built once here.
+    global TABLE
+    if TABLE is not None:
+        return
+    if not os.path.exists(path):
+        print(f"[ai] {path} not found, building it (run tablebase.py to do this ahead of time)")
+        try:
+            tablebase.write_table(build_records(), path)
+        except OSError as e:
+            raise tablebase.TablebaseError(f"Could not write {path}: {e}")
+    TABLE = tablebase.open_table(path, POSITIONS)
+
+def heuristic_move(me, opp):
+    moves = MOVES[FULL & ~(me | opp)]
+    if random.random() < 0.1:
+        return random.choice(moves)
+    for move in moves:
+        if WINNING[me | 1 << (move - 1)]:
+            return move
+    for move in moves:
+        if WINNING[opp | 1 << (move - 1)]:
+            return move
+    free = FULL & ~(me | opp)
+    if free & 1 << 4:
+        return 5
+    for move in [1, 3, 7, 9]:
+        if free & 1 << (move - 1):
+            return move
+    return random.choice(moves)
+
+def perfect_move(me, opp):
+    if TABLE is None:
+        load_tables()
+    best, _ = tablebase.read_record(TABLE, T3[me] + 2 * T3[opp])
+    return random.choice(MOVES[best])
+
+def line_move(board, me, opp):
+    # Heuristic for boards other than 3x3: win if possible, else block,
+    # else play next to existing stones where the longest own line grows
+    # or the opponent's longest line is cut.
+    geo = board.geo
+    stones = me | opp
+    if not stones:
+        return geo.cells // 2 + 1
+    free = geo.full & ~stones
+    candidates = [
+        cell for cell in range(1, geo.cells + 1)
+        if free >> (cell - 1) & 1 and any(side[:1] and side[0] & stones for ray in geo.rays[cell - 1] for side in ray)
+    ] or list(get_available_moves(board))
+    for mask in (me, opp):
+        for cell in candidates:
+            if max(runs(mask | 1 << (cell - 1), geo, cell)) >= geo.k:
+                return cell
+    best, best_score = [], -1
+    for cell in candidates:
+        bit = 1 << (cell - 1)
+        score = sum(4 ** n for n in runs(me | bit, geo, cell)) + sum(3 ** n for n in runs(opp | bit, geo, cell))
+        if score > best_score:
+            best, best_score = [cell], score
+        elif score == best_score:
+            best.append(cell)
+    return random.choice(best)
+
+def wants_search(level):
+    # Whether a move on a board bigger than 3x3 comes from search.best_move;
+    # like on 3x3, 'hard' plays the heuristic one move in ten.
+    if level == 'perfect':
+        return True
+    return level == 'hard' and random.random() >= 0.1
+
+def find_best_move(board, sign='X', level=DEFAULT_LEVEL, budget=search.SEARCH_BUDGET, searched=None):
+    # `searched` overrides the wants_search() roll, for callers that run the
+    # search themselves.
+    me, opp = (board.x, board.o) if sign == 'X' else (board.o, board.x)
+    if board.geo is not CLASSIC:
+        if level == 'easy':
+            return random.choice(get_available_moves(board))
+        if searched is None:
+            searched = wants_search(level)
+        if searched:
+            return search.best_move(me, opp, board.geo, budget)
+        return line_move(board, me, opp)
+    if level == 'easy':
+        return random.choice(MOVES[FULL & ~(me | opp)])
+    if level == 'normal':
+        return heuristic_move(me, opp)
+    if level == 'hard' and random.random() < 0.1:
+        return heuristic_move(me, opp)
+    return perfect_move(me, opp)
@@ -0,0 +1,89 @@
+import argparse
+import asyncio
+import random
+import time
+
+import server_gui
+from bench_memory import IdleTransport
+from engine import get_available_moves
+from scheduler import DeadlineScheduler
+
+class CountingTransport(IdleTransport):
+    __slots__ = ('writes', 'bytes')
+
+    def __init__(self, port):
+        super().__init__(port)
+        self.writes = 0
+        self.bytes = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes += len(data)
+
+def run_games(players, moves, rng):
+    # Every player makes `moves` moves, starting a rematch when a game ends;
+    # the server answers each one straight away.
+    for _ in range(moves):
+        for player in players:
+            if player.turn == server_gui.GAME_OVER:
+                player.data_received(b'NEW_GAME\n')
+            cell = rng.choice(get_available_moves(player.board))
+            player.data_received(f'{cell}\n'.encode())
+
+async def measure(games, watchers, moves, slow, config):
+    # Players and spectators talk to real sessions over in-memory transports,
+    # so the time is the server's own: game logic plus fan-out.
+    scheduler = DeadlineScheduler()
+    rng = random.Random(1)
+    players = []
+    for i in range(games):
+        player = server_gui.GameSession(scheduler, config)
+        player.connection_made(IdleTransport(i))
+        players.append(player)
+    transports = []
+    for player in players:
+        request = f'WATCH {player.session_id}\n'.encode()
+        for _ in range(watchers):
+            transport = CountingTransport(0)
+            session = server_gui.GameSession(scheduler, config)
+            session.connection_made(transport)
+            session.data_received(request)
+            transports.append(transport)
+    # Spectators that never catch up: their protocol sees pause_writing().
+    stalled = [w for player in players for w in player.watchers or ()][:int(len(transports) * slow)]
+    for watcher in stalled:
+        watcher.pause_writing()
+    before = dict(server_gui.STATS)
+    setup_bytes = sum(t.bytes for t in transports)
+    started = time.perf_counter()
+    run_games(players, moves, rng)
+    elapsed = time.perf_counter() - started
+    stats = {key: server_gui.STATS[key] - before.get(key, 0)
+             for key in ('watch_updates', 'watch_sent', 'watch_skipped', 'watchers_dropped')}
+    sent_bytes = sum(t.bytes for t in transports) - setup_bytes
+    for player in players:
+        player.connection_lost(None)
+    return elapsed, stats, sent_bytes
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Throughput of board updates fanned out to spectators")
+    parser.add_argument('-g', '--games', type=int, default=10)
+    parser.add_argument('-w', '--watchers', type=int, action='append',
+                        help="spectators per game (repeatable; default: 0, 100 and 500)")
+    parser.add_argument('-m', '--moves', type=int, default=200, help="client moves per game")
+    parser.add_argument('--slow', type=float, default=0.0,
+                        help="fraction of spectators that never read")
+    parser.add_argument('--policy', choices=server_gui.SLOW_WATCHERS, default='latest',
+                        help="what slow spectators get (as server_gui.py --slow-watchers)")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    server_gui.QUIET = True
+    config = server_gui.parse_args(['--benchmark'])
+    config.slow_watchers = args.policy
+    for watchers in args.watchers or (0, 100, 500):
+        elapsed, stats, sent_bytes = asyncio.run(measure(args.games, watchers, args.moves, args.slow, config))
+        print(f"{args.games} games x {watchers:>4} spectators: {stats['watch_updates'] / elapsed:>8.0f} updates/s, "
+              f"{stats['watch_sent'] / elapsed:>9.0f} lines/s to spectators ({sent_bytes / elapsed / 2**20:.1f} MiB/s), "
+              f"{stats['watch_skipped']} skipped, {stats['watchers_dropped']} dropped, {elapsed:.2f} s")
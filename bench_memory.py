@@ -0,0 +1,85 @@
+import argparse
+import asyncio
+import gc
+import tracemalloc
+
+import protocol
+import server_gui
+from scheduler import DeadlineScheduler
+
+COUNTS = (10000, 100000)
+
+class IdleTransport(asyncio.Transport):
+    # Stands in for a socket so that 100k sessions fit in one process without
+    # 100k file descriptors. Replies are discarded.
+    __slots__ = ('closing',)
+
+    def __init__(self, port):
+        super().__init__({'peername': ('127.0.0.1', port), 'socket': None})
+        self.closing = False
+
+    def write(self, data):
+        pass
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        self.closing = True
+
+    def abort(self):
+        self.closing = True
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def set_protocol(self, protocol):
+        pass
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def get_write_buffer_size(self):
+        return 0
+
+async def measure(count, compact, config):
+    # Bytes allocated per session by the server: the session object, its
+    # buffers, board and pending deadline. Transports are created before
+    # tracing starts, so the kernel and asyncio socket state is not included.
+    scheduler = DeadlineScheduler()
+    transports = [IdleTransport(i & 0xFFFF) for i in range(count)]
+    hello = (protocol.hello() + '\n').encode()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for transport in transports:
+        session = server_gui.GameSession(scheduler, config)
+        session.connection_made(transport)
+        if compact:
+            session.data_received(hello)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    idle = sum(1 for session in server_gui.SESSIONS.values() if session.turn == server_gui.CLIENT_TURN)
+    for session in list(server_gui.SESSIONS.values()):
+        session.connection_lost(None)
+    return used, idle
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Memory used by idle game sessions")
+    parser.add_argument('-n', '--sessions', type=int, action='append',
+                        help="number of idle sessions (repeatable; default: 10000 and 100000)")
+    parser.add_argument('--protocol', choices=('text', 'compact'), default='text')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    server_gui.QUIET = True
+    config = server_gui.parse_args(['--benchmark'])
+    for count in args.sessions or COUNTS:
+        used, idle = asyncio.run(measure(count, args.protocol == 'compact', config))
+        print(f"{count:>7} idle sessions ({idle} waiting for a move): "
+              f"{used / count:.0f} bytes/session, {used / 2**20:.1f} MiB total")
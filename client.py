@@ -1,15 +1,21 @@
 import socket
 import sys
 
+import protocol
+from engine import init_board, apply_move, board_to_string
+
 HOST = '172.16.187.3' # change to server's ip address
 PORT = 65432
+USE_COMPACT = True # ask the server for the one-frame-per-turn protocol
+BOARD_SIZE = 3 # ask for a bigger board, e.g. 15 with WIN_LENGTH = 5
+WIN_LENGTH = 3
 
 def safe_recv_line(s_file):
     try:
         line = s_file.readline()
         if not line:
             raise ConnectionResetError("Connection closed by server.")
-        return line.strip()
+        return line.decode().strip()
     except Exception as e:
         print(f"Error receiving data: {e}")
         raise
@@ -21,6 +27,117 @@ def safe_send(sock, msg):
         print(f"Error sending data: {e}")
         raise
 
+def safe_recv_frame(s_file):
+    data = s_file.read(protocol.FRAME.size)
+    if len(data) < protocol.FRAME.size:
+        raise ConnectionResetError("Connection closed by server.")
+    return protocol.unpack(data)
+
+def negotiate(s_file):
+    # The server has already sent its first prompt; the next line answers HELLO.
+    # Returns (version, seconds for the first move, board size, k).
+    safe_recv_line(s_file)
+    reply = safe_recv_line(s_file)
+    version, time_left, size, k = protocol.parse_welcome(reply)
+    if version is None:
+        version = protocol.TEXT_VERSION
+    return version, time_left, size, k
+
+def print_board_lines(s_file, size):
+    for _ in range(size):
+        print(safe_recv_line(s_file))
+
+def play_text(sock, s_file, size):
+    # Returns True once the game has a result.
+    while True:
+        prompt = safe_recv_line(s_file)
+        print(prompt)
+
+        if prompt in protocol.FINAL_MESSAGES:
+            return True
+
+        move = input().strip()
+        safe_send(sock, move)
+
+        response = safe_recv_line(s_file)
+        if response == "Invalid move!":
+            print("Invalid move! Try again.")
+            continue
+
+        if response == "MOVE_ACCEPTED":
+            print("Your move applied:")
+            print_board_lines(s_file, size)
+
+            msg = safe_recv_line(s_file)
+            if msg == "Server's turn":
+                print(msg)
+                print_board_lines(s_file, size)
+                result = safe_recv_line(s_file)
+            else:
+                result = msg
+
+            if result in protocol.FINAL_MESSAGES:
+                print(result)
+                return True
+        else:
+            print("Unexpected response from server:", response)
+            return False
+
+def play_compact(sock, s_file, time_left, size, k):
+    board = init_board(size, k)
+    cells = board.geo.cells
+    seen = 0
+    while True:
+        move = input(f"Your move (1-{cells}, {time_left} s left): ").strip()
+        try:
+            cell = int(move)
+        except ValueError:
+            print("Invalid move! Try again.")
+            continue
+        if not 1 <= cell <= cells:
+            print("Invalid move! Try again.")
+            continue
+        sock.sendall(protocol.pack_move(cell, seen))
+
+        kind, result, client_cell, server_cell, time_left = safe_recv_frame(s_file)
+        if kind == protocol.FRAME_TIMEOUT:
+            print("Time is up! You lost this game.")
+            return False
+        if kind == protocol.FRAME_INVALID:
+            print("Invalid move! Try again.")
+            continue
+        apply_move(board, client_cell, 'O')
+        if server_cell:
+            print(f"Server played {server_cell}")
+            apply_move(board, server_cell, 'X')
+            seen = server_cell
+        print(board_to_string(board, numbered=True))
+        if result != protocol.RESULT_CONTINUE:
+            print(protocol.RESULT_TEXT[result])
+            return True
+
+def ask_rematch():
+    try:
+        answer = input("Play again? (y/n): ").strip().lower()
+    except EOFError:
+        return False
+    return answer in ('y', 'yes')
+
+def request_new_game(sock, s_file, version):
+    # Rematch on the same connection; the server answers with the running score.
+    if version == protocol.COMPACT_VERSION:
+        sock.sendall(protocol.pack_new_game())
+        kind, _, client_wins, server_wins, draws = safe_recv_frame(s_file)
+        if kind != protocol.FRAME_NEW_GAME:
+            raise ConnectionResetError("Server does not support rematches.")
+    else:
+        safe_send(sock, protocol.NEW_GAME)
+        score = protocol.parse_score(safe_recv_line(s_file))
+        if score is None:
+            raise ConnectionResetError("Server does not support rematches.")
+        client_wins, server_wins, draws = score
+    print(f"Score - you: {client_wins}, server: {server_wins}, draws: {draws}")
+
 def handle_server_disconnect():
     print("\nServer disconnected. Game ended.")
     sys.exit(1)
@@ -42,64 +159,45 @@ try:
         finally:
             s.settimeout(None)
 
-        s_file = s.makefile('r')
+        s_file = s.makefile('rb')
         print("Connected to server")
+        send_hello = USE_COMPACT or BOARD_SIZE != 3
+        if send_hello:
+            version = protocol.COMPACT_VERSION if USE_COMPACT else protocol.TEXT_VERSION
+            safe_send(s, protocol.hello(version, BOARD_SIZE, WIN_LENGTH))
 
-        print("Initial board:")
         try:
-            for _ in range(3):
-                print(safe_recv_line(s_file))
-        except ConnectionResetError:
-            handle_server_disconnect()
-
-        while True:
-            try:
-                prompt = safe_recv_line(s_file)
-                print(prompt)
-
-                if prompt in ["You win!", "Server wins!", "Draw!"]:
-                    break
-
-                move = input().strip()
-                safe_send(s, move)
-
-                response = safe_recv_line(s_file)
-                if response == "Invalid move!":
-                    print("Invalid move! Try again.")
-                    continue
-
-                if response == "MOVE_ACCEPTED":
-                    print("Your move applied:")
-                    try:
-                        for _ in range(3):  
-                            print(safe_recv_line(s_file))
-
-                        msg = safe_recv_line(s_file)
-                        if msg == "Server's turn":
-                            print(msg)
-                            for _ in range(3):  
-                                print(safe_recv_line(s_file))
-                            result = safe_recv_line(s_file)
-                        else:
-                            result = msg 
-
-                        if result in ["You win!", "Server wins!", "Draw!"]:
-                            print(result)
-                            break
-                    except ConnectionResetError:
-                        handle_server_disconnect()
+            print("Initial board:")
+            print_board_lines(s_file, 3)
+
+            version, time_left, size, k = protocol.TEXT_VERSION, 0, 3, 3
+            if send_hello:
+                version, time_left, size, k = negotiate(s_file)
+                if size != 3:
+                    print(f"Playing on a {size}x{size} board, {k} in a row wins.")
+                    if version == protocol.TEXT_VERSION:
+                        print_board_lines(s_file, size)
+
+            while True:
+                if version == protocol.COMPACT_VERSION:
+                    finished = play_compact(s, s_file, time_left, size, k)
                 else:
-                    print("Unexpected response from server:", response)
+                    finished = play_text(s, s_file, size)
+                if not finished or not ask_rematch():
                     break
+                request_new_game(s, s_file, version)
+                if version == protocol.TEXT_VERSION:
+                    print("New board:")
+                    print_board_lines(s_file, size)
 
-            except ConnectionResetError:
-                handle_server_disconnect()
-            except KeyboardInterrupt:
-                print("\nClient closed manually.")
-                sys.exit(0)
-            except Exception as e:
-                print(f"Unexpected error: {e}")
-                sys.exit(1)
+        except ConnectionResetError:
+            handle_server_disconnect()
+        except KeyboardInterrupt:
+            print("\nClient closed manually.")
+            sys.exit(0)
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+            sys.exit(1)
 
 except Exception as e:
     print(f"Unexpected error in client: {e}")
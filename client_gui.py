@@ -1,10 +1,18 @@
+import asyncio
 import flet as ft
-import socket
-import threading
+import math
 import time
 
+import protocol
+
 HOST = '172.16.187.3' # change to server's ip address
 PORT = 65432
+USE_COMPACT = True # ask the server for the one-frame-per-turn protocol
+BOARD_SIZE = 3 # ask for a bigger board, e.g. 15 with WIN_LENGTH = 5
+WIN_LENGTH = 3
+DEBUG_OVERLAY = False # show how long each server message takes to reach the screen
+RESUME_ATTEMPTS = 5 # reconnects tried, a second apart, when a game in progress drops
+PLAYER_NAME = None # e.g. 'alice': records your games in the server's ratings under this name
 
 class TicTacToeClient:
     def __init__(self, page: ft.Page):
@@ -16,16 +24,27 @@ class TicTacToeClient:
         self.page.padding = 30
         self.page.vertical_alignment = ft.MainAxisAlignment.CENTER
         self.board_controls = []
-        self.socket = None
-        self.s_file = None
+        self.board_size = 3
+        self.reader = None
+        self.writer = None
+        self.listener = None
+        self.compact = False
+        self.connected = False
+        self.awaiting_new_game = False
         self.my_turn = True
         self.last_game_status = None
         self.client_score = 0
         self.server_score = 0
+        self.draws = 0
         self.move_timer = None
         self.move_time_limit = 60
-        self.timer_thread = None
-        self.timer_running = False
+        self.first_move_time = None
+        # Sent with every compact move; see protocol.pack_move().
+        self.last_server_cell = 0
+        # From WELCOME; lets a dropped game be picked up where it was.
+        self.resume_token = None
+        # Controls changed since the last render(); sent to Flet in one update.
+        self.dirty = set()
 
         self.status_text = ft.Text("Connecting to server...", 
                                  size=20, 
@@ -51,6 +70,8 @@ class TicTacToeClient:
             horizontal_alignment=ft.CrossAxisAlignment.CENTER
         )
 
+        self.debug_text = ft.Text("", size=12, visible=DEBUG_OVERLAY)
+
         self.restart_button = ft.ElevatedButton(
             content=ft.Text("Try again", size=22, weight=ft.FontWeight.BOLD),
             width=180,
@@ -79,163 +100,392 @@ class TicTacToeClient:
                 alignment=ft.MainAxisAlignment.CENTER
             )
         )
+        self.page.add(self.debug_text)
 
-        threading.Thread(target=self.connect_to_server, daemon=True).start()
+        # Networking and the move timer are tasks on Flet's event loop.
+        self.listener = asyncio.create_task(self.connect_to_server())
         self.page.on_window_event = self.on_window_close
 
-    def handle_button_click(self, e, idx):
+    async def handle_button_click(self, e):
         if self.my_turn:
-            self.send_move(idx + 1)
-
-    def build_board(self):
+            await self.send_move(e.control.data + 1)
+
+    def build_board(self, size=3):
+        # Bigger boards get smaller, tighter cells and a window to fit them.
+        self.board_size = size
+        cell = 100 if size == 3 else max(24, 420 // size)
+        gap = 10 if size == 3 else 2
+        if size != 3:
+            self.page.window_width = size * (cell + gap) + 2 * self.page.padding
+            self.page.window_height = self.page.window_width + 200
+        self.board_grid.spacing = gap
         self.board_grid.controls = []
         self.board_controls.clear()
-        for i in range(3):
+        for i in range(size):
             row = []
-            for j in range(3):
-                idx = i * 3 + j
+            for j in range(size):
+                idx = i * size + j
                 btn = ft.ElevatedButton(
-                    content=ft.Text(" ", size=38, weight=ft.FontWeight.BOLD),
-                    width=100,
-                    height=100,
+                    content=ft.Text(" ", size=cell * 0.38, weight=ft.FontWeight.BOLD),
+                    width=cell,
+                    height=cell,
                     style=ft.ButtonStyle(
                         shape=ft.RoundedRectangleBorder(radius=5),
-                        padding=20,
+                        padding=cell // 5,
                     ),
                     data=idx,
-                    on_click=lambda e, idx=idx: self.handle_button_click(e, idx)
+                    on_click=self.handle_button_click
                 )
                 self.board_controls.append(btn)
                 row.append(btn)
             self.board_grid.controls.append(
-                ft.Row(controls=row, alignment=ft.MainAxisAlignment.CENTER)
+                ft.Row(controls=row, spacing=gap, alignment=ft.MainAxisAlignment.CENTER)
             )
         self.page.update()
 
-    def connect_to_server(self):
+    def set_value(self, control, value, attr='value'):
+        # Records a change; nothing reaches Flet until render().
+        if getattr(control, attr) != value:
+            setattr(control, attr, value)
+            self.dirty.add(control)
+
+    def render(self, started=None):
+        # One update for everything changed while handling a message or event.
+        controls, self.dirty = self.dirty, set()
+        if controls:
+            self.page.update(*controls)
+        if DEBUG_OVERLAY and started is not None:
+            self.debug_text.value = f"UI latency: {(time.perf_counter() - started) * 1000:.1f} ms"
+            self.debug_text.update()
+
+    async def connect_to_server(self):
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((HOST, PORT))
-            self.s_file = self.socket.makefile('r')
-            self.status_text.value = "Connected to server. Waiting for your move."
-            self.page.update()
-            self.update_board_from_server()
-            self.listen_to_server()
+            self.reader, self.writer = await asyncio.open_connection(HOST, PORT)
+            self.connected = True
+            # Always HELLO, even for the text protocol on 3x3: WELCOME carries
+            # the resume token.
+            version = protocol.COMPACT_VERSION if USE_COMPACT else protocol.TEXT_VERSION
+            await self.send((protocol.hello(version, BOARD_SIZE, WIN_LENGTH, PLAYER_NAME) + '\n').encode())
+            self.set_value(self.status_text, "Connected to server. Waiting for your move.")
+            # The server always opens with a 3x3 board; HELLO may change it.
+            await self.update_board_from_server(3)
+            self.render()
+            if await self.negotiate():
+                self.my_turn = True
+                self.set_value(self.status_text, "Your turn!")
+                self.start_move_timer(self.first_move_time)
+                self.render()
+                await self.listen_to_server_compact()
+            else:
+                await self.listen_to_server()
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            self.page.update()
+            self.render()
             ft.dialog.alert(self.page, f"Connection error: {e}")
 
-    def safe_recv_line(self):
-        line = self.s_file.readline()
+    async def safe_recv_line(self):
+        line = await self.reader.readline()
         if not line:
             raise ConnectionResetError("Server disconnected.")
-        return line.strip()
+        return line.decode().strip()
 
-    def send_move(self, move):
+    async def safe_recv_frame(self):
+        try:
+            data = await self.reader.readexactly(protocol.FRAME.size)
+        except asyncio.IncompleteReadError:
+            raise ConnectionResetError("Server disconnected.") from None
+        return protocol.unpack(data)
+
+    async def send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def negotiate(self):
+        # The server's first prompt is already on its way; the line after it
+        # answers our HELLO ("Invalid move!" from servers without version 2).
+        await self.safe_recv_line()
+        welcome = await self.safe_recv_line()
+        version, self.first_move_time, size, _ = protocol.parse_welcome(welcome)
+        # Text prompts don't say how long is left; every move gets this much.
+        if self.first_move_time:
+            self.move_time_limit = self.first_move_time
+        self.resume_token = protocol.resume_token(welcome)
+        self.compact = version == protocol.COMPACT_VERSION
+        if size != self.board_size:
+            self.build_board(size)
+        if size != 3 and not self.compact:
+            # Text servers resend the board once it is not 3x3.
+            await self.update_board_from_server()
+            self.render()
+        return self.compact
+
+    async def send_move(self, move):
         if not self.my_turn:
             return
         self.my_turn = False
         self.cancel_move_timer()
         try:
-            self.socket.sendall(f"{move}\n".encode())
+            if self.compact:
+                await self.send(protocol.pack_move(move, self.last_server_cell))
+                self.set_value(self.status_text, "Server is thinking...")
+            else:
+                await self.send(f"{move}\n".encode())
+            self.render()
         except Exception as e:
             ft.dialog.alert(self.page, f"Send failed: {e}")
             self.page.window_destroy()
 
     def update_board(self, board_lines):
+        # Only cells whose symbol changed are marked for the next render.
         for i, line in enumerate(board_lines):
             cells = line.split('|')
             for j, cell in enumerate(cells):
-                idx = i * 3 + j
-                self.board_controls[idx].content.value = cell.strip() if cell.strip() else " "
-        self.page.update()
+                idx = i * self.board_size + j
+                self.set_value(self.board_controls[idx].content, cell.strip() or " ")
 
     def disable_all_buttons(self):
         for btn in self.board_controls:
-            btn.disabled = True
-        self.restart_button.visible = True
-        self.page.update()
+            self.set_value(btn, True, 'disabled')
+        self.set_value(self.restart_button, True, 'visible')
 
-    def update_board_from_server(self):
-        board_lines = [self.safe_recv_line() for _ in range(3)]
+    async def update_board_from_server(self, rows=None):
+        board_lines = [await self.safe_recv_line() for _ in range(rows or self.board_size)]
         self.update_board(board_lines)
 
-    def restart_game(self, e):
+    def reset_board(self):
+        self.last_server_cell = 0
+        for btn in self.board_controls:
+            self.set_value(btn.content, " ")
+            self.set_value(btn, False, 'disabled')
+
+    async def restart_game(self, e):
+        # Rematches reuse the open connection; the listener task is still
+        # running and picks up the server's answer to NEW_GAME.
         self.cancel_move_timer()
+        self.my_turn = False
+        self.last_game_status = None
+        self.set_value(self.restart_button, False, 'visible')
+        self.reset_board()
+        if self.connected:
+            try:
+                self.awaiting_new_game = True
+                if self.compact:
+                    await self.send(protocol.pack_new_game())
+                else:
+                    await self.send((protocol.NEW_GAME + '\n').encode())
+                self.set_value(self.status_text, "Starting a new game...")
+                self.render()
+                return
+            except (OSError, RuntimeError) as ex:
+                print(f"[restart_game] NEW_GAME failed: {ex}")
+        self.reconnect()
+
+    def close_connection(self):
         try:
-            if self.socket:
-                self.socket.close()
+            if self.writer:
+                self.writer.close()
         except Exception as ex:
-            print(f"[restart_game] Socket close error: {ex}")
-        self.board_controls.clear()
-        self.socket = None
-        self.s_file = None
+            print(f"[close_connection] Socket close error: {ex}")
+        self.reader = None
+        self.writer = None
+        # A listener still reading the old connection is stopped; when the
+        # listener itself reconnects it simply returns afterwards.
+        if self.listener is not None and self.listener is not asyncio.current_task():
+            self.listener.cancel()
+        self.listener = None
+
+    def reconnect(self):
+        self.close_connection()
+        self.compact = False
+        self.connected = False
+        self.resume_token = None
+        self.awaiting_new_game = False
         self.my_turn = True
         self.last_game_status = None
-        self.status_text.value = "Connecting to server..."
-        self.restart_button.visible = False
-        self.build_board()
-        self.page.update()
-        threading.Thread(target=self.connect_to_server, daemon=True).start()
+        self.set_value(self.status_text, "Connecting to server...")
+        self.render()
+        self.listener = asyncio.create_task(self.connect_to_server())
+
+    def start_new_game(self):
+        self.awaiting_new_game = False
+        self.last_game_status = None
+        self.reset_board()
+        self.set_value(self.status_text, "New game started.")
 
-    def listen_to_server(self):
+    async def listen_to_server(self):
         try:
             while True:
-                msg = self.safe_recv_line()
+                msg = await self.safe_recv_line()
+                started = time.perf_counter()
 
-                if msg == "Your move (1-9):":
+                if protocol.is_prompt(msg):
                     self.my_turn = True
-                    self.status_text.value = "Your turn!"
+                    self.set_value(self.status_text, "Your turn!")
                     self.start_move_timer()
 
                 elif msg == "Invalid move!":
-                    self.status_text.value = "Invalid move! Try again."
+                    self.set_value(self.status_text, "Invalid move! Try again.")
                     self.my_turn = True
 
                 elif msg == "MOVE_ACCEPTED":
-                    self.status_text.value = "Server is thinking..."
-                    self.update_board_from_server()
+                    self.set_value(self.status_text, "Server is thinking...")
+                    await self.update_board_from_server()
 
                 elif msg == "Server's turn":
-                    self.status_text.value = "Server is thinking..."
-                    self.update_board_from_server()
+                    self.set_value(self.status_text, "Server is thinking...")
+                    await self.update_board_from_server()
 
-                elif msg in ["You win!", "Server wins!", "Draw!"]:
-                    self.cancel_move_timer()
-                    self.last_game_status = msg
-                    self.status_text.value = msg
-                    self.update_score(msg)
-                    self.disable_all_buttons()
-                    ft.dialog.alert(self.page, msg)
-                    self.page.update()
-                    return
+                elif msg in protocol.FINAL_MESSAGES:
+                    self.finish_game(msg)
 
                 elif msg == "CONTINUE":
                     pass
 
+                elif protocol.parse_score(msg) is not None:
+                    self.set_score(*protocol.parse_score(msg))
+                    self.start_new_game()
+                    await self.update_board_from_server()
+
                 else:
                     print("Unknown message:", msg)
 
-                self.page.update()
+                self.render(started)
 
         except ConnectionResetError:
-            if self.last_game_status in ["You win!", "Server wins!", "Draw!"]:
-                return
-            ft.dialog.alert(self.page, "Server disconnected.")
-            self.status_text.value = "Connection failed."
-            self.page.update()
-            self.page.window_destroy()
+            self.handle_disconnect()
 
-    def on_window_close(self, e):
+    async def listen_to_server_compact(self):
+        try:
+            while True:
+                kind, result, client_cell, server_cell, time_left = await self.safe_recv_frame()
+                started = time.perf_counter()
+
+                if kind == protocol.FRAME_TIMEOUT:
+                    self.cancel_move_timer()
+                    self.on_move_timeout()
+                    return
+
+                elif kind == protocol.FRAME_INVALID:
+                    self.set_value(self.status_text, "Invalid move! Try again.")
+                    self.my_turn = True
+                    self.start_move_timer(time_left)
+
+                elif kind == protocol.FRAME_REPLY:
+                    # Cell 0: no move of ours, e.g. a relayed opponent's first move.
+                    if client_cell:
+                        self.set_value(self.board_controls[client_cell - 1].content, "O")
+                    if server_cell:
+                        self.set_value(self.board_controls[server_cell - 1].content, "X")
+                        self.last_server_cell = server_cell
+                    if result != protocol.RESULT_CONTINUE:
+                        self.finish_game(protocol.RESULT_TEXT[result])
+                    else:
+                        self.my_turn = True
+                        self.set_value(self.status_text, "Your turn!")
+                        self.start_move_timer(time_left)
+
+                elif kind == protocol.FRAME_NEW_GAME:
+                    self.set_score(client_cell, server_cell, time_left)
+                    self.start_new_game()
+                    self.my_turn = True
+                    self.set_value(self.status_text, "Your turn!")
+                    self.start_move_timer(self.first_move_time)
+
+                else:
+                    print("Unknown frame:", kind)
+
+                self.render(started)
+
+        except ConnectionResetError:
+            self.handle_disconnect()
+
+    def finish_game(self, msg):
         self.cancel_move_timer()
+        self.last_game_status = msg
+        self.set_value(self.status_text, msg)
+        self.update_score(msg)
+        self.disable_all_buttons()
+        ft.dialog.alert(self.page, msg)
+
+    def handle_disconnect(self):
+        self.connected = False
+        if self.awaiting_new_game:
+            # The server closed instead of starting a rematch (older servers
+            # end the connection after every game): connect again.
+            self.reconnect()
+            return
+        if self.last_game_status in protocol.FINAL_MESSAGES:
+            return
+        if self.resume_token is not None:
+            self.close_connection()
+            self.listener = asyncio.create_task(self.resume_game())
+            return
+        ft.dialog.alert(self.page, "Server disconnected.")
+        self.set_value(self.status_text, "Connection failed.")
+        self.render()
+        self.page.window_destroy()
+
+    async def resume_game(self):
+        # The server keeps a dropped game for a while; RESUME gets its board
+        # back in one line and the game goes on from there.
+        self.cancel_move_timer()
+        self.my_turn = False
+        self.set_value(self.status_text, "Connection lost. Resuming...")
+        self.render()
+        state = None
+        for attempt in range(RESUME_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(1.0)
+            try:
+                self.reader, self.writer = await asyncio.open_connection(HOST, PORT)
+                await self.send(f"RESUME {self.resume_token}\n".encode())
+                # The usual 3x3 board and prompt come first.
+                for _ in range(4):
+                    await self.safe_recv_line()
+                state = protocol.parse_resumed(await self.safe_recv_line())
+                break
+            except OSError as ex:
+                print(f"[resume_game] attempt {attempt + 1} failed: {ex}")
+                if self.writer is not None:
+                    self.writer.close()
+        if state is None:
+            ft.dialog.alert(self.page, "The game could not be resumed.")
+            self.reconnect()
+            return
+        version, seconds, size, _, cells, server_turn = state
+        self.connected = True
+        self.compact = version == protocol.COMPACT_VERSION
+        if size != self.board_size:
+            self.build_board(size)
+        for control, cell in zip(self.board_controls, cells):
+            self.set_value(control.content, " " if cell == '.' else cell)
+            self.set_value(control, False, 'disabled')
         try:
-            if self.socket:
-                self.socket.close()
-        except Exception as ex:
-            print(f"[on_window_close] Socket close error: {ex}")
+            if server_turn:
+                self.set_value(self.status_text, "Server is thinking...")
+                if not self.compact:
+                    # As after "Server's turn": the server's board comes next.
+                    await self.update_board_from_server()
+            else:
+                self.my_turn = True
+                self.set_value(self.status_text, "Your turn!")
+                self.start_move_timer(seconds)
+            self.render()
+        except ConnectionResetError:
+            self.handle_disconnect()
+            return
+        if self.compact:
+            await self.listen_to_server_compact()
+        else:
+            await self.listen_to_server()
+
+    def on_window_close(self, e):
+        self.cancel_move_timer()
+        self.close_connection()
 
     def get_score_text(self):
-        return f"Client: {self.client_score}   Server: {self.server_score}"
+        return f"Client: {self.client_score}   Server: {self.server_score}   Draws: {self.draws}"
 
     def update_score(self, result):
         if result == "You win!":
@@ -243,49 +493,54 @@ class TicTacToeClient:
         elif result == "Server wins!":
             self.server_score += 1
         elif result == "Draw!":
-            self.client_score += 1
-            self.server_score += 1
-        self.score_text.value = self.get_score_text()
-        self.page.update()
-
-    def start_move_timer(self):
+            self.draws += 1
+        self.set_value(self.score_text, self.get_score_text())
+
+    def set_score(self, client_score, server_score, draws):
+        # The server's count wins: with PLAYER_NAME set it covers every game
+        # we played there, not just this window's.
+        self.client_score, self.server_score, self.draws = client_score, server_score, draws
+        self.set_value(self.score_text, self.get_score_text())
+
+    def start_move_timer(self, seconds=None):
+        # In the compact protocol the server tells us how long we have;
+        # otherwise use the per-move limit from WELCOME.
         self.cancel_move_timer()
-        self.time_left = self.move_time_limit
-        self.timer_running = True
-
-        def timer_logic():
-            start = time.monotonic()
-            while self.timer_running and self.time_left > 0 and self.my_turn:
-                elapsed = int(time.monotonic() - start)
-                left = max(self.move_time_limit - elapsed, 0)
-                if left != self.time_left:
-                    self.time_left = left
-                    self.timer_text.value = f"Time left: {self.time_left} s"
-                    self.page.update()
-                time.sleep(0.1)
-            if self.timer_running and self.time_left <= 0 and self.my_turn:
-                self.on_move_timeout()
-
-        self.timer_thread = threading.Thread(target=timer_logic, daemon=True)
-        self.timer_thread.start()
+        deadline = time.monotonic() + (seconds or self.move_time_limit)
+        self.move_timer = asyncio.create_task(self.run_move_timer(deadline))
+
+    async def run_move_timer(self, deadline):
+        # Wakes once per displayed second, at the moment the shown value
+        # changes, instead of polling the clock.
+        while True:
+            left = math.ceil(deadline - time.monotonic())
+            if left <= 0:
+                break
+            self.set_value(self.timer_text, f"Time left: {left} s")
+            self.render()
+            await asyncio.sleep(deadline - (left - 1) - time.monotonic())
+        self.move_timer = None
+        self.set_value(self.timer_text, "")
+        self.render()
+        # The server enforces the deadline in the compact protocol and
+        # sends a TIMEOUT frame; the text protocol has no such message.
+        if not self.compact and self.my_turn:
+            self.on_move_timeout()
 
     def cancel_move_timer(self):
-        self.timer_running = False
-        self.timer_text.value = ""
-        self.page.update()
+        if self.move_timer is not None:
+            self.move_timer.cancel()
+            self.move_timer = None
+        self.set_value(self.timer_text, "")
 
     def on_move_timeout(self):
-        self.status_text.value = "Time is up! You lost this game."
-        self.page.update()
+        self.set_value(self.status_text, "Time is up! You lost this game.")
+        self.render()
         ft.dialog.alert(self.page, "Time is up! You lost this game.")
-        try:
-            if self.socket:
-                self.socket.close()
-        except Exception:
-            pass
+        self.close_connection()
         self.page.window_destroy()
 
-def main(page: ft.Page):
+async def main(page: ft.Page):
     TicTacToeClient(page)
 
 ft.app(target=main)
\ No newline at end of file
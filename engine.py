@@ -0,0 +1,177 @@
+from functools import lru_cache
+
+# Cells are numbered 1..size*size on the wire, row by row; cell n lives in
+# bit n - 1 of a side's mask. The classic 3x3 board has lookup tables below.
+SIZE = 3
+CELLS = SIZE * SIZE
+FULL = (1 << CELLS) - 1
+MAX_SIZE = 19
+DEFAULT_WIN = 5
+# Row/column steps of the four line directions: across, down and both diagonals.
+DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+LINES = (
+    0b000000111, 0b000111000, 0b111000000,  # rows
+    0b001001001, 0b010010010, 0b100100100,  # columns
+    0b100010001, 0b001010100,               # diagonals
+)
+
+# WINNING[mask] is True when the mask covers at least one full line.
+WINNING = tuple(any(mask & line == line for line in LINES) for mask in range(FULL + 1))
+
+# MOVES[free] lists the cell numbers set in a free-cell mask.
+MOVES = tuple(tuple(i + 1 for i in range(CELLS) if free >> i & 1) for free in range(FULL + 1))
+
+class Geometry:
+    # Shape of a size x size board won with k in a row. rays[cell] holds, for
+    # each direction, the bits of the up to k - 1 cells on either side of the
+    # cell, nearest first, so a line through the last move is found in O(k).
+    __slots__ = ('size', 'k', 'cells', 'full', 'rays')
+
+    def __init__(self, size, k):
+        self.size = size
+        self.k = k
+        self.cells = size * size
+        self.full = (1 << self.cells) - 1
+        self.rays = tuple(self._rays(divmod(i, size)) for i in range(self.cells))
+
+    def _rays(self, cell):
+        rays = []
+        for dr, dc in DIRECTIONS:
+            sides = []
+            for sign in (1, -1):
+                bits = []
+                row, col = cell
+                for _ in range(self.k - 1):
+                    row += dr * sign
+                    col += dc * sign
+                    if not (0 <= row < self.size and 0 <= col < self.size):
+                        break
+                    bits.append(1 << (row * self.size + col))
+                sides.append(tuple(bits))
+            rays.append(tuple(sides))
+        return tuple(rays)
+
+    @property
+    def classic(self):
+        return self is CLASSIC
+
+@lru_cache(maxsize=None)
+def geometry(size=SIZE, k=SIZE):
+    if not 3 <= size <= MAX_SIZE or not 3 <= k <= size:
+        raise ValueError(f"Unsupported board {size}x{size} with {k} in a row")
+    return Geometry(size, k)
+
+CLASSIC = geometry(SIZE, SIZE)
+
+class Board:
+    __slots__ = ('x', 'o', 'geo')
+
+    def __init__(self, x=0, o=0, geo=CLASSIC):
+        self.x = x
+        self.o = o
+        self.geo = geo
+
+    def mask(self, sign):
+        return self.x if sign == 'X' else self.o
+
+    def free(self):
+        return self.geo.full & ~(self.x | self.o)
+
+    def copy(self):
+        return Board(self.x, self.o, self.geo)
+
+def init_board(size=SIZE, k=None):
+    if k is None:
+        k = min(size, DEFAULT_WIN)
+    return Board(geo=geometry(size, k))
+
+def apply_move(board, move, sign):
+    try:
+        move = int(move)
+    except (ValueError, TypeError):
+        return False
+    if not 1 <= move <= board.geo.cells:
+        return False
+    bit = 1 << (move - 1)
+    if (board.x | board.o) & bit:
+        return False
+    if sign == 'X':
+        board.x |= bit
+    else:
+        board.o |= bit
+    return True
+
+def runs(mask, geo, move):
+    # Length of the line of `mask` stones through cell `move` in each direction,
+    # counting the cell itself.
+    lengths = []
+    for ahead, behind in geo.rays[move - 1]:
+        length = 1
+        for bit in ahead:
+            if not mask & bit:
+                break
+            length += 1
+        for bit in behind:
+            if not mask & bit:
+                break
+            length += 1
+        lengths.append(length)
+    return lengths
+
+def check_victory(board, sign, last_move=None):
+    # With last_move only the lines through that cell are checked, so the
+    # cost does not depend on the board size. 3x3 boards use a lookup table.
+    mask = board.mask(sign)
+    geo = board.geo
+    if geo is CLASSIC:
+        return WINNING[mask]
+    if last_move is not None:
+        return max(runs(mask, geo, int(last_move))) >= geo.k
+    return any(mask >> i & 1 and max(runs(mask, geo, i + 1)) >= geo.k for i in range(geo.cells))
+
+def is_draw(board):
+    return (board.x | board.o) == board.geo.full
+
+def get_available_moves(board):
+    free = board.free()
+    if board.geo is CLASSIC:
+        return MOVES[free]
+    return tuple(i + 1 for i in range(board.geo.cells) if free >> i & 1)
+
+@lru_cache(maxsize=4096)
+def _row_text(row, x, o, numbered, size):
+    # Cells are padded to the width of the largest cell number, so columns
+    # line up on boards with more than nine cells.
+    width = len(str(size * size)) if numbered else 1
+    cells = []
+    for col in range(size):
+        bit = 1 << col
+        if x & bit:
+            cells.append('X'.ljust(width))
+        elif o & bit:
+            cells.append('O'.ljust(width))
+        else:
+            cells.append(str(row * size + col + 1).ljust(width) if numbered else ' ')
+    return ' | '.join(cells)
+
+def board_rows(board, numbered=False):
+    # Free cells are shown as their number (console protocol) or a blank (GUI protocol).
+    size = board.geo.size
+    row_mask = (1 << size) - 1
+    return [
+        _row_text(row, board.x >> (row * size) & row_mask, board.o >> (row * size) & row_mask, numbered, size)
+        for row in range(size)
+    ]
+
+def board_cells(board):
+    # The board as one character per cell, X, O or '.', in cell order.
+    x, o = board.x, board.o
+    return ''.join('X' if x >> i & 1 else 'O' if o >> i & 1 else '.' for i in range(board.geo.cells))
+
+def board_to_string(board, numbered=False):
+    return '\n'.join(board_rows(board, numbered))
+
+def display_board(board, numbered=False):
+    print(board_to_string(board, numbered))
+    print()
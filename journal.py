@@ -0,0 +1,104 @@
+import os
+import struct
+import threading
+import time
+
+# A journal file is a header followed by fixed-size records:
+#   header  magic, format version, start time (Unix seconds)
+#   record  session id, milliseconds since the start time, event, result
+# The event is a client cell (1..size*size), a server cell (SERVER_MOVE | cell),
+# OPEN when a player connects, CLOSE when the connection ends, or SHAPE
+# (see shape_event) when a player asks for a board other than 3x3. The
+# result byte uses the protocol.RESULT_* values.
+MAGIC = b'TTTJ'
+VERSION = 2
+HEADER = struct.Struct('!4sBd')
+RECORD = struct.Struct('!IIHB')
+SERVER_MOVE = 0x1000
+OPEN = 0x2000
+CLOSE = 0x2001
+SHAPE = 0x4000
+FLUSH_INTERVAL = 1.0
+
+class JournalError(Exception):
+    pass
+
+def read_header(f):
+    data = f.read(HEADER.size)
+    if len(data) < HEADER.size:
+        raise JournalError("Journal header is truncated")
+    magic, version, start = HEADER.unpack(data)
+    if magic != MAGIC or version != VERSION:
+        raise JournalError("Not a game journal, or an unsupported version")
+    return start
+
+def shape_event(size, k):
+    return SHAPE | size << 5 | k
+
+def parse_shape(event):
+    # (size, k) for a SHAPE event, otherwise None.
+    if event & SHAPE:
+        return event >> 5 & 0x1F, event & 0x1F
+    return None
+
+def worker_path(path, index):
+    # Pre-fork workers each append to their own file.
+    root, ext = os.path.splitext(path)
+    return f"{root}-{index}{ext}"
+
+class JournalWriter:
+    # The game loop only packs records into a memory buffer; a background
+    # thread writes the buffer and fsyncs every `interval` seconds, so disk
+    # latency never reaches a session.
+    def __init__(self, path, interval=FLUSH_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.start = time.time()
+            self.file.write(HEADER.pack(MAGIC, VERSION, self.start))
+        else:
+            with open(path, 'rb') as f:
+                self.start = read_header(f)
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='journal', daemon=True)
+        self.thread.start()
+
+    def record(self, session, event, result=0):
+        ms = int((time.time() - self.start) * 1000) & 0xFFFFFFFF
+        data = RECORD.pack(session & 0xFFFFFFFF, ms, event, result)
+        with self.lock:
+            self.buffer += data
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            data, self.buffer = self.buffer, bytearray()
+        if data:
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.file.close()
+
+def read_journal(path):
+    # Yields (session, time in Unix seconds, event, result) in file order.
+    # A torn record at the end (the process died mid-write) is ignored.
+    with open(path, 'rb') as f:
+        start = read_header(f)
+        while True:
+            data = f.read(RECORD.size * 4096)
+            whole = len(data) - len(data) % RECORD.size
+            for session, ms, event, result in RECORD.iter_unpack(data[:whole]):
+                yield session, start + ms / 1000.0, event, result
+            if whole < RECORD.size * 4096:
+                return
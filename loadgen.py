@@ -0,0 +1,248 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+import protocol
+
+HOST = '127.0.0.1'
+PORT = 65432
+
+class ProtocolMismatch(Exception):
+    pass
+
+class Stats:
+    def __init__(self):
+        self.games = 0
+        self.results = Counter()
+        self.move_latencies = []
+        self.connect_latencies = []
+        self.new_game_latencies = []
+        self.errors = Counter()
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def parse_free_cells(rows):
+    cells = [cell.strip() for row in rows for cell in row.split('|')]
+    return [i + 1 for i, cell in enumerate(cells) if cell not in ('X', 'O')]
+
+async def read_line(reader, timeout):
+    line = await asyncio.wait_for(reader.readline(), timeout)
+    if not line:
+        raise ConnectionResetError("Server closed the connection")
+    return line.decode().strip()
+
+async def read_board(reader, timeout, size=3):
+    return [await read_line(reader, timeout) for _ in range(size)]
+
+async def play_text(reader, writer, stats, timeout, size=3):
+    free = parse_free_cells(await read_board(reader, timeout, size))
+    while True:
+        prompt = await read_line(reader, timeout)
+        if not protocol.is_prompt(prompt):
+            raise ProtocolMismatch(f"expected prompt, got {prompt!r}")
+        start = time.perf_counter()
+        move = random.choice(free)
+        writer.write(f"{move}\n".encode())
+
+        response = await read_line(reader, timeout)
+        if response == "Invalid move!":
+            # Against another player (server.py) the first move is made
+            # before the opponent's shows up on a board.
+            free.remove(move)
+            continue
+        if response != "MOVE_ACCEPTED":
+            raise ProtocolMismatch(f"expected MOVE_ACCEPTED, got {response!r}")
+        free = parse_free_cells(await read_board(reader, timeout, size))
+        status = await read_line(reader, timeout)
+        if status == "Server's turn":
+            free = parse_free_cells(await read_board(reader, timeout, size))
+            status = await read_line(reader, timeout)
+        stats.move_latencies.append(time.perf_counter() - start)
+
+        if status in protocol.FINAL_MESSAGES:
+            return status
+        if status != "CONTINUE":
+            raise ProtocolMismatch(f"unexpected status {status!r}")
+
+async def negotiate(reader, writer, timeout, version=protocol.COMPACT_VERSION, size=3, k=3):
+    # The 3x3 board and prompt sent on connect come before the WELCOME.
+    # Returns the board size the server chose.
+    writer.write((protocol.hello(version, size, k) + '\n').encode())
+    await read_board(reader, timeout)
+    await read_line(reader, timeout)
+    granted, _, size, k = protocol.parse_welcome(await read_line(reader, timeout))
+    if granted != version:
+        raise ProtocolMismatch(f"server does not support protocol version {version}")
+    return size
+
+async def play_compact(reader, writer, stats, timeout, size=3):
+    free = set(range(1, size * size + 1))
+    seen = 0
+    while True:
+        move = random.choice(tuple(free))
+        start = time.perf_counter()
+        writer.write(protocol.pack_move(move, seen))
+        data = await asyncio.wait_for(reader.readexactly(protocol.FRAME.size), timeout)
+        stats.move_latencies.append(time.perf_counter() - start)
+
+        kind, result, client_cell, server_cell, _ = protocol.unpack(data)
+        if kind != protocol.FRAME_REPLY:
+            raise ProtocolMismatch(f"unexpected frame type {kind}")
+        free.discard(client_cell)
+        free.discard(server_cell)
+        seen = server_cell or seen
+        if result != protocol.RESULT_CONTINUE:
+            return protocol.RESULT_TEXT[result]
+
+async def request_new_game(reader, writer, stats, args):
+    start = time.perf_counter()
+    if args.protocol == 'compact':
+        writer.write(protocol.pack_new_game())
+        data = await asyncio.wait_for(reader.readexactly(protocol.FRAME.size), args.timeout)
+        if protocol.unpack(data)[0] != protocol.FRAME_NEW_GAME:
+            raise ProtocolMismatch("expected NEW_GAME frame")
+    else:
+        writer.write((protocol.NEW_GAME + '\n').encode())
+        if protocol.parse_score(await read_line(reader, args.timeout)) is None:
+            raise ProtocolMismatch("expected SCORE line")
+    stats.new_game_latencies.append(time.perf_counter() - start)
+
+async def play_connection(args, stats, games_left, deadline):
+    # Plays one game, or with --rematch up to games_left games (until the
+    # deadline) on one connection. Returns the number of games attempted.
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(args.host, args.port), args.timeout)
+    except asyncio.TimeoutError:
+        stats.errors['connect_timeout'] += 1
+        return 1
+    except OSError:
+        stats.errors['connect_failed'] += 1
+        return 1
+    stats.connect_latencies.append(time.perf_counter() - start)
+
+    play = play_compact if args.protocol == 'compact' else play_text
+    played = 0
+    try:
+        size = 3
+        if args.protocol == 'compact':
+            size = await negotiate(reader, writer, args.timeout, protocol.COMPACT_VERSION, args.size, args.win)
+        elif args.size != 3:
+            size = await negotiate(reader, writer, args.timeout, protocol.TEXT_VERSION, args.size, args.win)
+        while True:
+            played += 1
+            result = await play(reader, writer, stats, args.timeout, size)
+            stats.games += 1
+            stats.results[result] += 1
+            if not args.rematch or played >= games_left or time.monotonic() >= deadline:
+                break
+            await request_new_game(reader, writer, stats, args)
+    except asyncio.TimeoutError:
+        stats.errors['timeout'] += 1
+    except (ConnectionError, asyncio.IncompleteReadError):
+        stats.errors['disconnected'] += 1
+    except ProtocolMismatch:
+        stats.errors['protocol'] += 1
+    finally:
+        writer.close()
+    return max(played, 1)
+
+async def run_bot(args, stats, deadline):
+    played = 0
+    while time.monotonic() < deadline and (args.games is None or played < args.games):
+        games_left = float('inf') if args.games is None else args.games - played
+        played += await play_connection(args, stats, games_left, deadline)
+
+async def run(args):
+    stats = Stats()
+    start = time.monotonic()
+    deadline = start + args.duration if args.duration else float('inf')
+    await asyncio.gather(*(run_bot(args, stats, deadline) for _ in range(args.connections)))
+    return stats, time.monotonic() - start
+
+def summarize(stats, elapsed, args):
+    ms = 1000.0
+    return {
+        'connections': args.connections,
+        'protocol': args.protocol,
+        'elapsed_s': round(elapsed, 3),
+        'games': stats.games,
+        'games_per_s': round(stats.games / elapsed, 1) if elapsed else 0.0,
+        'results': dict(stats.results),
+        'moves': len(stats.move_latencies),
+        'move_latency_ms': {
+            'p50': round(percentile(stats.move_latencies, 50) * ms, 3),
+            'p95': round(percentile(stats.move_latencies, 95) * ms, 3),
+            'p99': round(percentile(stats.move_latencies, 99) * ms, 3),
+        },
+        'connect_latency_ms': {
+            'p50': round(percentile(stats.connect_latencies, 50) * ms, 3),
+            'p99': round(percentile(stats.connect_latencies, 99) * ms, 3),
+        },
+        'rematch': args.rematch,
+        'new_game_latency_ms': {
+            'p50': round(percentile(stats.new_game_latencies, 50) * ms, 3),
+            'p99': round(percentile(stats.new_game_latencies, 99) * ms, 3),
+        },
+        'errors': dict(stats.errors),
+    }
+
+def print_report(summary):
+    print(f"Connections:     {summary['connections']} ({summary['protocol']} protocol)")
+    print(f"Elapsed:         {summary['elapsed_s']:.2f} s")
+    print(f"Games:           {summary['games']} ({summary['games_per_s']:.1f} games/s)")
+    print(f"Results:         {summary['results']}")
+    lat = summary['move_latency_ms']
+    print(f"Move -> reply:   p50 {lat['p50']:.3f} ms  p95 {lat['p95']:.3f} ms  p99 {lat['p99']:.3f} ms")
+    lat = summary['connect_latency_ms']
+    print(f"Connect:         p50 {lat['p50']:.3f} ms  p99 {lat['p99']:.3f} ms")
+    if summary['rematch']:
+        lat = summary['new_game_latency_ms']
+        print(f"NEW_GAME:        p50 {lat['p50']:.3f} ms  p99 {lat['p99']:.3f} ms")
+    print(f"Errors:          {summary['errors'] or 'none'}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Headless load generator for the Tic-Tac-Toe servers")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('-c', '--connections', type=int, default=50,
+                        help="number of concurrent bot clients")
+    parser.add_argument('-n', '--games', type=int, default=None,
+                        help="games per bot client (default: 20 unless --duration is set)")
+    parser.add_argument('-d', '--duration', type=float, default=None,
+                        help="stop starting new games after this many seconds")
+    parser.add_argument('--protocol', choices=('text', 'compact'), default='text')
+    parser.add_argument('--size', type=int, default=3, help="ask for a SIZE x SIZE board")
+    parser.add_argument('--win', type=int, default=None,
+                        help="stones in a row needed to win (default: size, at most 5)")
+    parser.add_argument('--rematch', action='store_true',
+                        help="keep each connection open and start further games with NEW_GAME")
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help="seconds to wait for any single server response")
+    parser.add_argument('--json', action='store_true', help="print the summary as JSON")
+    args = parser.parse_args()
+    if args.games is None and args.duration is None:
+        args.games = 20
+    if args.win is None:
+        args.win = min(args.size, 5)
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    try:
+        stats, elapsed = asyncio.run(run(args))
+    except KeyboardInterrupt:
+        print("\nLoad generator stopped manually.")
+    else:
+        summary = summarize(stats, elapsed, args)
+        if args.json:
+            print(json.dumps(summary))
+        else:
+            print_report(summary)
@@ -0,0 +1,137 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = 'tictactoe_'
+METRICS_HOST = '127.0.0.1'
+
+# Upper bounds in seconds; one more slot counts everything above the last one.
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Stats counter key -> (metric name, type, help, labels). The servers keep
+# plain Counters on the hot path; names and labels are only applied here.
+COUNTERS = {
+    'accepted': ('connections_accepted_total', 'counter', "Connections accepted", ''),
+    'active': ('sessions_active', 'gauge', "Connected players", ''),
+    'games': ('games_finished_total', 'counter', "Games played to the end", ''),
+    'client_wins': ('games_total', 'counter', "Games by result", 'result="client_win"'),
+    'server_wins': ('games_total', 'counter', "Games by result", 'result="server_win"'),
+    'draws': ('games_total', 'counter', "Games by result", 'result="draw"'),
+    'unfinished': ('games_total', 'counter', "Games by result", 'result="unfinished"'),
+    'first_wins': ('games_total', 'counter', "Games by result", 'result="first_player_win"'),
+    'second_wins': ('games_total', 'counter', "Games by result", 'result="second_player_win"'),
+    'rematches': ('rematches_total', 'counter', "Games started with NEW_GAME", ''),
+    'timeouts': ('move_timeouts_total', 'counter', "Players who ran out of time", ''),
+    'disconnects': ('disconnects_total', 'counter', "Connections closed", ''),
+    'bytes_in': ('received_bytes_total', 'counter', "Bytes received from players", ''),
+    'bytes_out': ('sent_bytes_total', 'counter', "Bytes sent to players", ''),
+    'spectators': ('spectators_active', 'gauge', "Connected spectators", ''),
+    'watch_updates': ('watch_updates_total', 'counter', "Board updates published to spectators", ''),
+    'watch_sent': ('watch_frames_sent_total', 'counter', "Board updates written to spectators", ''),
+    'watch_skipped': ('watch_frames_skipped_total', 'counter', "Board updates a slow spectator skipped", ''),
+    'watchers_dropped': ('watchers_dropped_total', 'counter', "Slow spectators disconnected", ''),
+    'rooms': ('rooms_active', 'gauge', "Player vs player games in progress", ''),
+    'queued': ('matchmaking_queued', 'gauge', "Players waiting for an opponent", ''),
+    'orphaned': ('sessions_orphaned', 'gauge', "Dropped games waiting to be resumed", ''),
+    'resumed': ('sessions_resumed_total', 'counter', "Dropped games resumed", ''),
+    'orphans_expired': ('orphans_expired_total', 'counter', "Dropped games given up", ''),
+    'rated_games': ('rated_games_total', 'counter', "Games recorded for named players", ''),
+    'leaderboards': ('leaderboard_requests_total', 'counter', "LEADERBOARD requests answered", ''),
+    'waiting': ('sessions_waiting', 'gauge', "Players queued for a free slot", ''),
+    'rejected_full': ('rejected_total', 'counter', "Players turned away", 'reason="full"'),
+    'rate_limited': ('rejected_total', 'counter', "Players turned away", 'reason="rate_limited"'),
+    'stalled_readers': ('rejected_total', 'counter', "Players turned away", 'reason="not_reading"'),
+    'workers': ('workers', 'gauge', "Worker processes alive", ''),
+    'restarts': ('worker_restarts_total', 'counter', "Worker processes restarted", ''),
+}
+
+HISTOGRAM_HELP = {
+    'move_seconds': "Time to handle a batch of client input and write the reply",
+    'ai_seconds': "Time spent choosing the server's move",
+}
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def snapshot(self):
+        return list(self.counts), self.sum
+
+    def merge(self, snapshot):
+        counts, total = snapshot
+        for i, count in enumerate(counts):
+            self.counts[i] += count
+        self.sum += total
+
+def snapshot_all(histograms):
+    return {name: hist.snapshot() for name, hist in histograms.items()}
+
+def merge_snapshots(snapshots):
+    # Sums snapshot_all() results (e.g. one per worker) into fresh histograms.
+    merged = {}
+    for snapshot in snapshots:
+        for name, data in snapshot.items():
+            hist = merged.get(name)
+            if hist is None:
+                hist = merged[name] = Histogram()
+            hist.merge(data)
+    return merged
+
+def render(stats, histograms):
+    # Prometheus text exposition format.
+    lines = []
+    seen = set()
+    # Sorted by metric name so that the labelled series of a family stay together.
+    series = sorted((COUNTERS.get(key, (key, 'untyped', key, '')), value) for key, value in stats.items())
+    for (name, kind, help_text, labels), value in series:
+        name = PREFIX + name
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+    for key, hist in sorted(histograms.items()):
+        name = PREFIX + key
+        lines.append(f"# HELP {name} {HISTOGRAM_HELP.get(key, key)}")
+        lines.append(f"# TYPE {name} histogram")
+        total = 0
+        for bound, count in zip(hist.buckets, hist.counts):
+            total += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {total}')
+        total += hist.counts[-1]
+        lines.append(f'{name}_bucket{{le="+Inf"}} {total}')
+        lines.append(f"{name}_sum {hist.sum}")
+        lines.append(f"{name}_count {total}")
+    return '\n'.join(lines) + '\n'
+
+def start_server(port, collect, host=METRICS_HOST):
+    # Serves collect() on http://host:port/metrics from a daemon thread, so
+    # scrapes never run on the game loop.
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = collect().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,227 @@
+import asyncio
+import selectors
+import socket
+import time
+
+MAX_LINE = 1024
+RECV_SIZE = 65536
+
+class ProtocolError(Exception):
+    pass
+
+class LineBuffer:
+    # Receive buffer that hands out complete '\n'-terminated lines (or, for
+    # the compact protocol, fixed-size frames). Bytes that were already
+    # scanned are not searched again when more data arrives.
+    __slots__ = ('data', 'max_line', 'scanned')
+
+    def __init__(self, max_line=MAX_LINE):
+        self.data = bytearray()
+        self.max_line = max_line
+        self.scanned = 0
+
+    def feed(self, chunk):
+        self.data += chunk
+
+    def next_line(self):
+        end = self.data.find(b'\n', self.scanned)
+        if end < 0:
+            self.scanned = len(self.data)
+            if self.scanned > self.max_line:
+                raise ProtocolError(f"Message longer than {self.max_line} bytes")
+            return None
+        if end > self.max_line:
+            raise ProtocolError(f"Message longer than {self.max_line} bytes")
+        line = self.data[:end].decode(errors='replace').strip()
+        del self.data[:end + 1]
+        self.scanned = 0
+        return line
+
+    def peek_line(self):
+        # The next complete line without consuming it, or None.
+        end = self.data.find(b'\n')
+        if end < 0:
+            return None
+        return self.data[:end].decode(errors='replace').strip()
+
+    def next_bytes(self, size):
+        if len(self.data) < size:
+            return None
+        chunk = bytes(self.data[:size])
+        del self.data[:size]
+        self.scanned = 0
+        return chunk
+
+def set_nodelay(sock):
+    # Every flush is a complete batch of lines, so there is nothing for Nagle
+    # to coalesce; waiting for the peer's ACK would only add latency.
+    if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+class FramedConnection:
+    # Blocking socket wrapper used by the console server. The socket stays in
+    # blocking mode; deadlines are enforced by waiting on a selector that is
+    # registered once, and only when the buffer has no complete line yet.
+    # Outgoing lines are queued and written with a single sendall() on flush().
+    def __init__(self, sock, max_line=MAX_LINE):
+        self.sock = sock
+        self.buffer = LineBuffer(max_line)
+        self.outgoing = []
+        self.bytes_in = 0
+        self.bytes_out = 0
+        set_nodelay(sock)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(sock, selectors.EVENT_READ)
+
+    def _fill(self, deadline):
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.selector.select(remaining):
+                raise TimeoutError("timed out")
+        chunk = self.sock.recv(RECV_SIZE)
+        if not chunk:
+            raise ConnectionResetError("Client disconnected.")
+        self.bytes_in += len(chunk)
+        self.buffer.feed(chunk)
+
+    def recv_line(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            line = self.buffer.next_line()
+            if line is not None:
+                return line
+            self._fill(deadline)
+
+    def recv_exact(self, size, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            chunk = self.buffer.next_bytes(size)
+            if chunk is not None:
+                return chunk
+            self._fill(deadline)
+
+    def queue(self, msg):
+        self.outgoing.append((msg + '\n').encode())
+
+    def queue_bytes(self, data):
+        self.outgoing.append(data)
+
+    def flush(self):
+        if self.outgoing:
+            data = b''.join(self.outgoing)
+            self.outgoing.clear()
+            self.sock.sendall(data)
+            self.bytes_out += len(data)
+
+    def send(self, msg):
+        self.queue(msg)
+        self.flush()
+
+    def peer_closed(self):
+        # True if the peer has hung up; never blocks and leaves any unread
+        # data where it is.
+        if self.buffer.data or not self.selector.select(0):
+            return False
+        try:
+            return not self.sock.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return True
+
+    def close(self):
+        self.selector.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class FramedProtocol(asyncio.Protocol):
+    # Event-driven counterpart for the asyncio server: no task or coroutine is
+    # kept per connection. Complete lines (or frames of frame_size bytes) are
+    # handed to on_line()/on_frame() as they arrive; while `receiving` is
+    # False, input is only buffered. Replies are queued and written with one
+    # transport.write() per batch of input.
+    __slots__ = ('transport', 'buffer', 'outgoing', 'frame_size', 'receiving', 'dispatching')
+
+    def __init__(self, max_line=MAX_LINE):
+        self.transport = None
+        self.buffer = LineBuffer(max_line)
+        self.outgoing = []
+        self.frame_size = None
+        self.receiving = True
+        self.dispatching = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        set_nodelay(transport.get_extra_info('socket'))
+
+    def data_received(self, data):
+        self.buffer.feed(data)
+        self.dispatch()
+
+    def pause_writing(self):
+        # The peer is not reading its replies; stop reading its requests.
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def dispatch(self):
+        if self.dispatching:
+            return
+        self.dispatching = True
+        try:
+            while self.receiving and not self.transport.is_closing():
+                if self.frame_size is None:
+                    line = self.buffer.next_line()
+                    if line is None:
+                        break
+                    self.on_line(line)
+                else:
+                    frame = self.buffer.next_bytes(self.frame_size)
+                    if frame is None:
+                        break
+                    self.on_frame(frame)
+        except Exception as e:
+            self.on_error(e)
+        finally:
+            self.dispatching = False
+        self.flush()
+
+    def resume_receiving(self):
+        self.receiving = True
+        self.dispatch()
+
+    def on_line(self, line):
+        pass
+
+    def on_frame(self, frame):
+        pass
+
+    def on_error(self, exc):
+        self.close()
+
+    def queue(self, msg):
+        self.outgoing.append((msg + '\n').encode())
+
+    def queue_bytes(self, data):
+        self.outgoing.append(data)
+
+    def flush(self):
+        # Returns the number of bytes written.
+        if not self.outgoing:
+            return 0
+        data = b''.join(self.outgoing)
+        self.outgoing.clear()
+        if self.transport.is_closing():
+            return 0
+        self.transport.write(data)
+        return len(data)
+
+    def close(self):
+        if self.transport is not None:
+            self.flush()
+            self.transport.close()
@@ -0,0 +1,241 @@
+import re
+import struct
+
+from engine import SIZE, MAX_SIZE
+
+# Version 1 is the original line protocol (prompts, MOVE_ACCEPTED, full boards).
+# A client that wants the compact protocol sends "HELLO 2" as its first line;
+# a server that supports it answers "WELCOME 2" and from then on both sides
+# exchange fixed-size binary frames. Older servers answer "Invalid move!",
+# which tells the client to stay on version 1. The WELCOME line also carries
+# the number of seconds the client has for each move.
+#
+# HELLO may also ask for a bigger board: "HELLO <version> <size> <k>" for a
+# size x size board won with k in a row. WELCOME then ends with the board the
+# server actually chose ("WELCOME <version> <seconds> <size> <k>"); without
+# it, the board is the classic 3x3. Cells are numbered 1..size*size.
+#
+# After a game ends the connection stays open: a client that wants a rematch
+# sends NEW_GAME (a line, or a NEW_GAME frame in version 2). The server
+# answers with the cumulative score for the connection ("SCORE <client wins>
+# <server wins> <draws>", or a NEW_GAME frame) and starts a fresh game.
+#
+# A connection can also watch a game instead of playing one: "WATCH <game>"
+# as its first line, or just "WATCH" for the newest game. The server answers
+# "WATCHING <game>" (or "No such game" and closes), then sends
+# "BOARD <game> <size> <k> <cells> <state>" with the current board and again
+# after every move: one character per cell (X, O or .) and the state of the
+# game (playing, client_win, server_win, draw, or closed once the player
+# leaves). Lines sent by a watcher are ignored.
+#
+# A WELCOME may end with a resume token, after the board size and k
+# ("WELCOME <version> <seconds> <size> <k> <token>"). If the connection drops
+# during a game, the client can reconnect and send "RESUME <token>" as its
+# first line instead of HELLO. After the usual greeting the server answers
+# with a single line, "RESUMED <version> <seconds> <size> <k> <cells> <turn>"
+# (cells as in BOARD, turn is your_turn or server_turn), and the game goes on
+# in that protocol version: the client moves, or the server's move follows as
+# if the client had just played. An unknown or expired token gets
+# "No such game" and the connection closes.
+#
+# HELLO may end with a player name after k ("HELLO <version> <size> <k>
+# <name>", 1-32 letters, digits, '.', '_' or '-'). A server that keeps ratings
+# then records the player's results, and SCORE counts all of its games there
+# rather than only this connection's. "LEADERBOARD [count]" as the first line
+# gets the best rated players, one "RANK <rank> <name> <rating> <wins>
+# <losses> <draws>" line each, and the connection closes.
+TEXT_VERSION = 1
+COMPACT_VERSION = 2
+SUPPORTED_VERSIONS = (TEXT_VERSION, COMPACT_VERSION)
+
+PROMPT_LINE = re.compile(r'Your move \(1-\d+\):')
+NEW_GAME = "NEW_GAME"
+
+RESULT_CONTINUE = 0
+RESULT_CLIENT_WIN = 1
+RESULT_SERVER_WIN = 2
+RESULT_DRAW = 3
+RESULT_TEXT = {
+    RESULT_CLIENT_WIN: "You win!",
+    RESULT_SERVER_WIN: "Server wins!",
+    RESULT_DRAW: "Draw!",
+}
+FINAL_MESSAGES = tuple(RESULT_TEXT.values())
+# Game states in BOARD lines; None means the player has left.
+WATCH_STATES = {
+    RESULT_CONTINUE: 'playing',
+    RESULT_CLIENT_WIN: 'client_win',
+    RESULT_SERVER_WIN: 'server_win',
+    RESULT_DRAW: 'draw',
+    None: 'closed',
+}
+
+# Frame layout: kind, status, then three unsigned 16-bit arguments.
+#   MOVE    client -> server  a = cell, b = the last server cell the client has seen (0 if none)
+#   REPLY   server -> client  status = result, a = client cell, b = server cell (0 if none),
+#                             c = seconds left for the client's next move
+#   INVALID server -> client  a = rejected cell, c = seconds left for the next try
+#   TIMEOUT server -> client  the client ran out of time; the server closes the game
+#   NEW_GAME client -> server  start another game on this connection
+#            server -> client  a = client wins, b = server wins, c = draws so far
+FRAME = struct.Struct('!BBHHH')
+FRAME_MOVE = 1
+FRAME_REPLY = 2
+FRAME_INVALID = 3
+FRAME_TIMEOUT = 4
+FRAME_NEW_GAME = 5
+
+PLAYER_NAME = re.compile(r'[A-Za-z0-9_.-]{1,32}')
+LEADERBOARD_SIZE = 10
+MAX_LEADERBOARD = 100
+
+def prompt(cells=SIZE * SIZE):
+    return f"Your move (1-{cells}):"
+
+# The prompt for the 3x3 board every connection starts with.
+PROMPT = prompt()
+
+def is_prompt(line):
+    return PROMPT_LINE.fullmatch(line) is not None
+
+def hello(version=COMPACT_VERSION, size=SIZE, k=SIZE, name=None):
+    # A name the server would not accept is left out.
+    if name and PLAYER_NAME.fullmatch(name):
+        return f"HELLO {version} {size} {k} {name}"
+    if size == SIZE and k == SIZE:
+        return f"HELLO {version}"
+    return f"HELLO {version} {size} {k}"
+
+def welcome(version, move_timeout=0, size=SIZE, k=SIZE, token=None):
+    if token is not None:
+        return f"WELCOME {version} {int(move_timeout)} {size} {k} {token}"
+    if size != SIZE or k != SIZE:
+        return f"WELCOME {version} {int(move_timeout)} {size} {k}"
+    return f"WELCOME {version} {int(move_timeout)}"
+
+def _parse_ints(line, keyword):
+    parts = line.split()
+    if not parts or parts[0] != keyword:
+        return None
+    try:
+        return [int(part) for part in parts[1:]]
+    except ValueError:
+        return None
+
+def parse_hello(line):
+    # Returns (version, size, k), or None if the line is not a HELLO.
+    parts = line.split()
+    if len(parts) == 5:
+        # The player name; see player_name().
+        line = ' '.join(parts[:4])
+    values = _parse_ints(line, 'HELLO')
+    if not values or len(values) not in (1, 3):
+        return None
+    return (values[0], SIZE, SIZE) if len(values) == 1 else tuple(values)
+
+def player_name(line):
+    # The player name at the end of a HELLO line, or None for an anonymous
+    # player (an invalid name counts as none).
+    parts = line.split()
+    if len(parts) != 5 or parts[0] != 'HELLO' or not PLAYER_NAME.fullmatch(parts[4]):
+        return None
+    return parts[4]
+
+def parse_welcome(line):
+    # Returns (version, seconds for the first move, size, k); version is None
+    # if the line is not a WELCOME.
+    values = _parse_ints(line, 'WELCOME')
+    if not values:
+        return None, 0, SIZE, SIZE
+    seconds = values[1] if len(values) > 1 else 0
+    size, k = values[2:4] if len(values) >= 4 else (SIZE, SIZE)
+    return values[0], seconds, size, k
+
+def resume_token(line):
+    # The resume token at the end of a WELCOME line, or None.
+    values = _parse_ints(line, 'WELCOME')
+    return values[4] if values and len(values) >= 5 else None
+
+def parse_resume(line):
+    values = _parse_ints(line, 'RESUME')
+    return values[0] if values and len(values) == 1 else None
+
+def resumed(version, seconds, size, k, cells, server_turn):
+    turn = 'server_turn' if server_turn else 'your_turn'
+    return f"RESUMED {version} {int(seconds)} {size} {k} {cells} {turn}"
+
+def parse_resumed(line):
+    # Returns (version, seconds, size, k, cells, server_turn), or None.
+    parts = line.split()
+    if len(parts) != 7 or parts[0] != 'RESUMED' or parts[6] not in ('your_turn', 'server_turn'):
+        return None
+    try:
+        version, seconds, size, k = (int(part) for part in parts[1:5])
+    except ValueError:
+        return None
+    if len(parts[5]) != size * size:
+        return None
+    return version, seconds, size, k, parts[5], parts[6] == 'server_turn'
+
+def parse_watch(line):
+    # Returns the game number to watch (0 for the newest game), or None if
+    # the line is not a WATCH.
+    values = _parse_ints(line, 'WATCH')
+    if values is None or len(values) > 1:
+        return None
+    return values[0] if values else 0
+
+def watching(game):
+    return f"WATCHING {game}"
+
+def board_update(game, size, k, cells, result):
+    return f"BOARD {game} {size} {k} {cells} {WATCH_STATES[result]}"
+
+def parse_leaderboard(line):
+    # Returns how many players to list, or None if the line is not a
+    # LEADERBOARD.
+    values = _parse_ints(line, 'LEADERBOARD')
+    if values is None or len(values) > 1:
+        return None
+    return min(max(values[0], 1), MAX_LEADERBOARD) if values else LEADERBOARD_SIZE
+
+def rank_line(rank, name, rating, wins, losses, draws):
+    return f"RANK {rank} {name} {round(rating)} {wins} {losses} {draws}"
+
+def choose_board(size, k, max_size=MAX_SIZE):
+    # The board the server plays for a requested shape; anything it does not
+    # support falls back to the classic 3x3.
+    if 3 <= k <= size <= max_size:
+        return size, k
+    return SIZE, SIZE
+
+def score_line(client_wins, server_wins, draws):
+    return f"SCORE {client_wins} {server_wins} {draws}"
+
+def parse_score(line):
+    values = _parse_ints(line, 'SCORE')
+    return tuple(values) if values and len(values) == 3 else None
+
+def negotiate(requested):
+    # Highest version both sides understand.
+    versions = [v for v in SUPPORTED_VERSIONS if v <= requested]
+    return max(versions) if versions else TEXT_VERSION
+
+def pack_move(cell, seen=0):
+    return FRAME.pack(FRAME_MOVE, 0, cell, seen, 0)
+
+def pack_reply(result, client_cell, server_cell=0, deadline=0):
+    return FRAME.pack(FRAME_REPLY, result, client_cell, server_cell, int(deadline))
+
+def pack_invalid(cell, deadline=0):
+    return FRAME.pack(FRAME_INVALID, 0, cell, 0, int(deadline))
+
+def pack_timeout():
+    return FRAME.pack(FRAME_TIMEOUT, 0, 0, 0, 0)
+
+def pack_new_game(client_wins=0, server_wins=0, draws=0):
+    # uint16 fields; the score wraps rather than overflowing the frame.
+    return FRAME.pack(FRAME_NEW_GAME, 0, client_wins & 0xFFFF, server_wins & 0xFFFF, draws & 0xFFFF)
+
+def unpack(data):
+    return FRAME.unpack(data)
@@ -0,0 +1,180 @@
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import protocol
+
+# Named players' results and an Elo rating against the server AI, whose
+# strength per level is fixed. The game loop only touches an in-memory cache
+# of player records; a background thread loads players it has not seen yet
+# and writes what changed in batches every `interval` seconds, so a finished
+# game never waits for the disk. Writes add the changes since the last batch
+# to the stored values instead of overwriting them, so pre-fork workers can
+# share one database. After every batch the thread also reads the best rated
+# players back, so the leaderboard costs the game loop nothing either.
+DEFAULT_RATING = 1200.0
+AI_RATINGS = {'easy': 800.0, 'normal': 1200.0, 'hard': 1600.0, 'perfect': 2000.0}
+K_FACTOR = 32.0
+FLUSH_INTERVAL = 1.0
+CACHE_SIZE = 100000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS players (
+    name TEXT PRIMARY KEY,
+    wins INTEGER NOT NULL DEFAULT 0,
+    losses INTEGER NOT NULL DEFAULT 0,
+    draws INTEGER NOT NULL DEFAULT 0,
+    rating REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS players_by_rating ON players (rating)
+"""
+SELECT = "SELECT name, wins, losses, draws, rating FROM players"
+UPSERT = """
+INSERT INTO players (name, wins, losses, draws, rating) VALUES (?, ?, ?, ?, ? + ?)
+ON CONFLICT (name) DO UPDATE SET wins = wins + excluded.wins, losses = losses + excluded.losses,
+    draws = draws + excluded.draws, rating = rating + excluded.rating - ?
+"""
+
+def expected(rating, opponent):
+    return 1.0 / (1.0 + 10.0 ** ((opponent - rating) / 400.0))
+
+class Player:
+    # Totals as the game loop sees them, plus what has changed since they
+    # were last written. Until `loaded`, the totals are only this process's
+    # changes; the stored values are added when the load finishes, and games
+    # wait in `pending` so they are rated against the stored rating.
+    __slots__ = ('name', 'wins', 'losses', 'draws', 'rating', 'changes', 'loaded', 'pending')
+
+    def __init__(self, name, wins=0, losses=0, draws=0, rating=DEFAULT_RATING, loaded=False):
+        self.name = name
+        self.wins = wins
+        self.losses = losses
+        self.draws = draws
+        self.rating = rating
+        # (wins, losses, draws, rating) not yet written, or None.
+        self.changes = None
+        self.loaded = loaded
+        # (level, score) of games finished before the load.
+        self.pending = []
+
+    def score(self):
+        return self.wins, self.losses, self.draws
+
+class RatingStore:
+    def __init__(self, path, interval=FLUSH_INTERVAL, cache_size=CACHE_SIZE):
+        self.interval = interval
+        self.cache_size = cache_size
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.executescript(SCHEMA)
+        # Name -> Player, least recently used first.
+        self.cache = OrderedDict()
+        # (name, wins, losses, draws, rating) of the best rated players,
+        # replaced as a whole by the background thread.
+        self.top = []
+        self.read_top()
+        self.dirty = set()
+        self.to_load = []
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='ratings', daemon=True)
+        self.thread.start()
+
+    def player(self, name):
+        # The cached record; a player not seen yet is loaded in the background.
+        with self.lock:
+            player = self.cache.get(name)
+            if player is not None:
+                self.cache.move_to_end(name)
+                return player
+            player = self.cache[name] = Player(name)
+            self.to_load.append(name)
+            self.evict()
+        self.wake.set()
+        return player
+
+    def record(self, player, level, result):
+        # result is a protocol.RESULT_* value from the player's point of view.
+        score = {protocol.RESULT_CLIENT_WIN: 1.0, protocol.RESULT_DRAW: 0.5}.get(result, 0.0)
+        wins, losses, draws = score == 1.0, score == 0.0, score == 0.5
+        with self.lock:
+            player.wins += wins
+            player.losses += losses
+            player.draws += draws
+            w, l, d, r = player.changes or (0, 0, 0, 0.0)
+            player.changes = (w + wins, l + losses, d + draws, r)
+            self.dirty.add(player)
+            if player.loaded:
+                self.rate(player, level, score)
+            else:
+                player.pending.append((level, score))
+
+    def rate(self, player, level, score):
+        # Called with the lock held, once the player's stored rating is in.
+        delta = K_FACTOR * (score - expected(player.rating, AI_RATINGS[level]))
+        player.rating += delta
+        w, l, d, r = player.changes or (0, 0, 0, 0.0)
+        player.changes = (w, l, d, r + delta)
+        self.dirty.add(player)
+
+    def leaderboard(self, count=protocol.LEADERBOARD_SIZE):
+        # As of the last batch, including other workers' games.
+        return self.top[:count]
+
+    def evict(self):
+        # Least recently used first; players with unwritten changes or still
+        # loading stay until the next batch.
+        while len(self.cache) > self.cache_size:
+            player = next(iter(self.cache.values()))
+            if player.changes is not None or not player.loaded:
+                break
+            del self.cache[player.name]
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.load()
+            self.flush()
+            self.read_top()
+        self.flush()
+
+    def load(self):
+        with self.lock:
+            names, self.to_load = self.to_load, []
+        for name in names:
+            row = self.db.execute(SELECT + " WHERE name = ?", (name,)).fetchone()
+            with self.lock:
+                player = self.cache[name]
+                if row is not None:
+                    _, wins, losses, draws, rating = row
+                    player.wins += wins
+                    player.losses += losses
+                    player.draws += draws
+                    player.rating += rating - DEFAULT_RATING
+                player.loaded = True
+                for level, score in player.pending:
+                    self.rate(player, level, score)
+                player.pending = []
+
+    def flush(self):
+        with self.lock:
+            rows = [(player.name, *player.changes, DEFAULT_RATING, DEFAULT_RATING) for player in self.dirty]
+            for player in self.dirty:
+                player.changes = None
+            self.dirty.clear()
+            self.evict()
+        if rows:
+            with self.db:
+                self.db.executemany(UPSERT, rows)
+
+    def read_top(self):
+        self.top = self.db.execute(SELECT + " ORDER BY rating DESC LIMIT ?", (protocol.MAX_LEADERBOARD,)).fetchall()
+
+    def close(self):
+        self.stopped.set()
+        self.wake.set()
+        self.thread.join()
+        self.db.close()
@@ -0,0 +1,194 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import journal
+import protocol
+from engine import SIZE
+from loadgen import HOST, PORT, ProtocolMismatch, Stats, negotiate, percentile
+
+class Replay:
+    # One recorded connection: when it opened and closed, its board, and the
+    # client's moves (time, cell) for each game played on it.
+    def __init__(self, opened):
+        self.opened = opened
+        self.closed = None
+        self.size = SIZE
+        self.k = SIZE
+        self.games = [[]]
+
+def load_replays(paths):
+    # Sessions are keyed by file as well, since every worker numbers its own.
+    replays = {}
+    for file_index, path in enumerate(paths):
+        for session, when, event, result in journal.read_journal(path):
+            key = (file_index, session)
+            replay = replays.get(key)
+            if replay is None:
+                replay = replays[key] = Replay(when)
+            if event == journal.CLOSE:
+                replay.closed = when
+                continue
+            if event == journal.OPEN:
+                continue
+            shape = journal.parse_shape(event)
+            if shape is not None:
+                replay.size, replay.k = shape
+                continue
+            if not event & journal.SERVER_MOVE:
+                replay.games[-1].append((when, event))
+            if result != protocol.RESULT_CONTINUE:
+                replay.games.append([])
+    return sorted((r for r in replays.values() if any(r.games)), key=lambda r: r.opened)
+
+class ReplayStats(Stats):
+    def __init__(self):
+        super().__init__()
+        self.diverged = 0
+        self.lag = []
+
+async def play_game(reader, writer, stats, moves, at, timeout, size):
+    # The server may answer differently than it did when the journal was
+    # written; recorded cells that are no longer free, and games that
+    # outlive their recording, are finished with random free cells.
+    free = set(range(1, size * size + 1))
+    moves = list(moves)
+    while True:
+        if moves:
+            when, cell = moves.pop(0)
+            await at(when)
+            if cell not in free:
+                cell = random.choice(tuple(free))
+                stats.diverged += 1
+        else:
+            cell = random.choice(tuple(free))
+            stats.diverged += 1
+        start = time.perf_counter()
+        writer.write(protocol.pack_move(cell))
+        data = await asyncio.wait_for(reader.readexactly(protocol.FRAME.size), timeout)
+        stats.move_latencies.append(time.perf_counter() - start)
+
+        kind, result, client_cell, server_cell, _ = protocol.unpack(data)
+        if kind != protocol.FRAME_REPLY:
+            raise ProtocolMismatch(f"unexpected frame type {kind}")
+        free.discard(client_cell)
+        free.discard(server_cell)
+        if result != protocol.RESULT_CONTINUE:
+            if moves:
+                stats.diverged += 1
+            return protocol.RESULT_TEXT[result]
+
+async def replay_connection(args, stats, replay, at):
+    await at(replay.opened)
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(args.host, args.port), args.timeout)
+    except (OSError, asyncio.TimeoutError):
+        stats.errors['connect_failed'] += 1
+        return
+    try:
+        size = await negotiate(reader, writer, args.timeout, protocol.COMPACT_VERSION, replay.size, replay.k)
+        played = 0
+        for moves in replay.games:
+            if not moves:
+                continue
+            if played:
+                await at(moves[0][0])
+                writer.write(protocol.pack_new_game())
+                data = await asyncio.wait_for(reader.readexactly(protocol.FRAME.size), args.timeout)
+                if protocol.unpack(data)[0] != protocol.FRAME_NEW_GAME:
+                    raise ProtocolMismatch("expected NEW_GAME frame")
+            result = await play_game(reader, writer, stats, moves, at, args.timeout, size)
+            played += 1
+            stats.games += 1
+            stats.results[result] += 1
+        if replay.closed is not None:
+            await at(replay.closed)
+    except asyncio.TimeoutError:
+        stats.errors['timeout'] += 1
+    except (ConnectionError, asyncio.IncompleteReadError):
+        stats.errors['disconnected'] += 1
+    except ProtocolMismatch:
+        stats.errors['protocol'] += 1
+    finally:
+        writer.close()
+
+async def run(args):
+    replays = load_replays(args.journals)
+    if not replays:
+        raise SystemExit("No games in the journal")
+    stats = ReplayStats()
+    loop = asyncio.get_running_loop()
+    origin = replays[0].opened
+    start = loop.time()
+
+    async def at(when):
+        # Sleeps until the recorded moment, scaled by --speed.
+        target = start + (when - origin) / args.speed
+        delay = target - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            stats.lag.append(-delay)
+
+    await asyncio.gather(*(replay_connection(args, stats, replay, at) for replay in replays))
+    return stats, len(replays), loop.time() - start
+
+def summarize(stats, connections, elapsed, args):
+    ms = 1000.0
+    return {
+        'connections': connections,
+        'speed': args.speed,
+        'elapsed_s': round(elapsed, 3),
+        'games': stats.games,
+        'games_per_s': round(stats.games / elapsed, 1) if elapsed else 0.0,
+        'results': dict(stats.results),
+        'diverged_moves': stats.diverged,
+        'move_latency_ms': {
+            'p50': round(percentile(stats.move_latencies, 50) * ms, 3),
+            'p99': round(percentile(stats.move_latencies, 99) * ms, 3),
+        },
+        'late_events': len(stats.lag),
+        'lag_p99_ms': round(percentile(stats.lag, 99) * ms, 3),
+        'errors': dict(stats.errors),
+    }
+
+def print_report(summary):
+    print(f"Connections:     {summary['connections']} (replayed at {summary['speed']}x)")
+    print(f"Elapsed:         {summary['elapsed_s']:.2f} s")
+    print(f"Games:           {summary['games']} ({summary['games_per_s']:.1f} games/s)")
+    print(f"Results:         {summary['results']}")
+    print(f"Diverged moves:  {summary['diverged_moves']}")
+    lat = summary['move_latency_ms']
+    print(f"Move -> reply:   p50 {lat['p50']:.3f} ms  p99 {lat['p99']:.3f} ms")
+    print(f"Behind schedule: {summary['late_events']} events, p99 {summary['lag_p99_ms']:.3f} ms")
+    print(f"Errors:          {summary['errors'] or 'none'}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay game journals against a server as a load test")
+    parser.add_argument('journals', nargs='+', help="journal files written by server_gui.py --journal")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+                        help="replay speed as a multiple of real time")
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help="seconds to wait for any single server response")
+    parser.add_argument('--json', action='store_true', help="print the summary as JSON")
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    try:
+        stats, connections, elapsed = asyncio.run(run(args))
+    except KeyboardInterrupt:
+        print("\nReplay stopped manually.")
+    else:
+        summary = summarize(stats, connections, elapsed, args)
+        if args.json:
+            print(json.dumps(summary))
+        else:
+            print_report(summary)
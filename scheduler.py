@@ -0,0 +1,93 @@
+import asyncio
+from collections import deque
+
+RESOLUTION = 0.25
+
+class DeadlineQueue(deque):
+    # Deadlines of one duration, plus how many of them are cancelled.
+    __slots__ = ('cancelled',)
+
+    def __init__(self):
+        super().__init__()
+        self.cancelled = 0
+
+    def compact(self):
+        live = [entry for entry in self if not entry.cancelled]
+        self.clear()
+        self.extend(live)
+        self.cancelled = 0
+
+class Deadline:
+    __slots__ = ('when', 'callback', 'cancelled', 'queue')
+
+    def __init__(self, when, callback, queue):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+        self.queue = queue
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        queue = self.queue
+        queue.cancelled += 1
+        # Every move cancels a deadline long before it expires; once most of
+        # the queue is dead, drop them rather than letting them pile up.
+        if queue.cancelled * 2 > len(queue):
+            queue.compact()
+
+class DeadlineScheduler:
+    # One event-loop timer serves the deadlines of every session. Deadlines are
+    # grouped by duration; within a group they expire in the order they were
+    # added, so each group is a FIFO and schedule()/cancel() are O(1) amortized.
+    # Cancelled entries are dropped when they reach the head of their queue, or
+    # all at once when they outnumber the live ones. Expiries are coalesced to
+    # RESOLUTION, so a server with many idle players wakes up at most a few times
+    # per second, and not at all when nothing is pending.
+    def __init__(self, resolution=RESOLUTION):
+        self.resolution = resolution
+        self.queues = {}
+        self.handle = None
+        self.handle_when = None
+
+    def schedule(self, delay, callback):
+        loop = asyncio.get_running_loop()
+        queue = self.queues.get(delay)
+        if queue is None:
+            queue = self.queues[delay] = DeadlineQueue()
+        entry = Deadline(loop.time() + delay, callback, queue)
+        queue.append(entry)
+        if self.handle is None or entry.when + self.resolution < self.handle_when:
+            self._arm(loop, entry.when)
+        return entry
+
+    def pending(self):
+        return sum(1 for queue in self.queues.values() for entry in queue if not entry.cancelled)
+
+    def _arm(self, loop, when):
+        if self.handle is not None:
+            self.handle.cancel()
+        self.handle_when = when + self.resolution
+        self.handle = loop.call_at(self.handle_when, self._fire)
+
+    def _fire(self):
+        loop = asyncio.get_running_loop()
+        self.handle = None
+        now = loop.time()
+        earliest = None
+        for delay, queue in list(self.queues.items()):
+            while queue and (queue[0].cancelled or queue[0].when <= now):
+                entry = queue.popleft()
+                if entry.cancelled:
+                    queue.cancelled -= 1
+                else:
+                    entry.cancelled = True
+                    entry.callback()
+            if not queue:
+                del self.queues[delay]
+            elif earliest is None or queue[0].when < earliest:
+                earliest = queue[0].when
+        # A callback may already have re-armed the timer for a new deadline.
+        if earliest is not None and (self.handle is None or earliest + self.resolution < self.handle_when):
+            self._arm(loop, earliest)
@@ -0,0 +1,274 @@
+import random
+import time
+from functools import lru_cache
+
+from engine import DIRECTIONS, geometry
+
+# Alpha-beta search for boards bigger than 3x3. Positions are seen from the
+# side to move (`me`, `opp` masks, as in ai.py). Every window of k cells in a
+# row is worth weights[n] to a side that has n stones in it and the other side
+# none; a full window is a win. Scores are updated incrementally per move.
+SEARCH_BUDGET = 0.5
+MAX_DEPTH = 12
+# Moves tried per node after ordering; the root looks at more.
+BRANCH = 8
+ROOT_BRANCH = 20
+TT_LIMIT = 200000
+WIN = 10 ** 9
+EXACT, LOWER, UPPER = 0, 1, 2
+
+class Timeout(Exception):
+    pass
+
+class Tables:
+    # Per-board lookup tables: the windows through each cell, the cells near
+    # each cell (moves far from every stone are never searched), window
+    # weights and Zobrist keys.
+    __slots__ = ('geo', 'windows', 'all_windows', 'near', 'weights', 'zobrist', 'turn_key')
+
+    def __init__(self, geo):
+        size, k = geo.size, geo.k
+        windows = [[] for _ in range(geo.cells)]
+        all_windows = []
+        for row in range(size):
+            for col in range(size):
+                for dr, dc in DIRECTIONS:
+                    end_row, end_col = row + dr * (k - 1), col + dc * (k - 1)
+                    if not (0 <= end_row < size and 0 <= end_col < size):
+                        continue
+                    cells = [(row + dr * i) * size + col + dc * i for i in range(k)]
+                    window = sum(1 << cell for cell in cells)
+                    all_windows.append(window)
+                    for cell in cells:
+                        windows[cell].append(window)
+        self.geo = geo
+        self.windows = tuple(tuple(w) for w in windows)
+        self.all_windows = tuple(all_windows)
+        self.near = tuple(
+            sum(1 << (r * size + c)
+                for r in range(max(0, row - 2), min(size, row + 3))
+                for c in range(max(0, col - 2), min(size, col + 3)))
+            for row, col in (divmod(i, size) for i in range(geo.cells))
+        )
+        # Each extra stone in a window is worth ten times the last; k stones win.
+        self.weights = tuple(10 ** n if n < k else WIN for n in range(k + 1))
+        rng = random.Random(size * 32 + k)
+        self.zobrist = tuple(tuple(rng.getrandbits(64) for _ in range(geo.cells)) for _ in range(2))
+        self.turn_key = rng.getrandbits(64)
+
+@lru_cache(maxsize=None)
+def tables(geo):
+    return Tables(geo)
+
+# Zobrist key -> (depth, score, bound, best cell index); shared by every
+# search in this process and emptied when it grows past TT_LIMIT.
+TRANSPOSITIONS = {}
+
+def gain(mine, theirs, windows, weights):
+    # Change in (my score - their score) when I take the cell whose windows
+    # are given: my open windows grow and their windows through it die.
+    total = 0
+    for window in windows:
+        if theirs & window:
+            if not mine & window:
+                total += weights[(theirs & window).bit_count()]
+        else:
+            n = (mine & window).bit_count()
+            total += weights[n + 1] - weights[n]
+    return total
+
+def completes(mine, theirs, windows, k):
+    # Whether taking the cell gives me k in a row.
+    for window in windows:
+        if not theirs & window and (mine & window).bit_count() == k - 1:
+            return True
+    return False
+
+def cells_of(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+def ordered(me, opp, candidates, t, first=None):
+    # Candidate cells, best first: the cell from the transposition table, then
+    # by attack plus defence value. Returns (score, cell) pairs with my gain.
+    windows, weights = t.windows, t.weights
+    scored = []
+    for cell in cells_of(candidates):
+        mine = gain(me, opp, windows[cell], weights)
+        scored.append((mine + gain(opp, me, windows[cell], weights), mine, cell))
+    scored.sort(reverse=True)
+    moves = [(mine, cell) for _, mine, cell in scored]
+    if first is not None:
+        for i, (_, cell) in enumerate(moves):
+            if cell == first:
+                moves.insert(0, moves.pop(i))
+                break
+    return moves
+
+class Searcher:
+    __slots__ = ('t', 'deadline', 'nodes')
+
+    def __init__(self, t, deadline):
+        self.t = t
+        self.deadline = deadline
+        self.nodes = 0
+
+    def negamax(self, me, opp, near, key, score, depth, alpha, beta, ply):
+        # `score` is the static evaluation for the side to move.
+        self.nodes += 1
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise Timeout()
+        t = self.t
+        candidates = near & t.geo.full & ~(me | opp)
+        if not candidates:
+            return 0
+        if depth == 1:
+            # The children would only return their evaluation, so take the
+            # best single move directly, looking at every candidate. Cells
+            # where the opponent would complete a line must be blocked; two
+            # of them cannot be.
+            best = -WIN
+            forced = []
+            for cell in cells_of(candidates):
+                mine = gain(me, opp, t.windows[cell], t.weights)
+                if mine >= WIN // 2:
+                    return WIN - ply
+                if completes(opp, me, t.windows[cell], t.geo.k):
+                    forced.append(score + mine)
+                best = max(best, score + mine)
+            if len(forced) > 1:
+                return -(WIN - ply - 1)
+            return forced[0] if forced else best
+
+        entry = TRANSPOSITIONS.get(key)
+        first = None
+        if entry is not None:
+            entry_depth, entry_score, bound, first = entry
+            if entry_depth >= depth:
+                if bound == EXACT:
+                    return entry_score
+                if bound == LOWER and entry_score >= beta:
+                    return entry_score
+                if bound == UPPER and entry_score <= alpha:
+                    return entry_score
+
+        original_alpha = alpha
+        best, best_cell = -WIN, None
+        zobrist = t.zobrist[ply & 1]
+        for mine, cell in ordered(me, opp, candidates, t, first)[:BRANCH]:
+            if mine >= WIN // 2:
+                best, best_cell = WIN - ply, cell
+                break
+            bit = 1 << cell
+            value = -self.negamax(opp, me | bit, near | t.near[cell], key ^ zobrist[cell] ^ t.turn_key,
+                                  -(score + mine), depth - 1, -beta, -alpha, ply + 1)
+            if value > best:
+                best, best_cell = value, cell
+            if best > alpha:
+                alpha = best
+            if alpha >= beta:
+                break
+
+        if len(TRANSPOSITIONS) >= TT_LIMIT:
+            TRANSPOSITIONS.clear()
+        bound = UPPER if best <= original_alpha else LOWER if best >= beta else EXACT
+        TRANSPOSITIONS[key] = (depth, best, bound, best_cell)
+        return best
+
+def position(me, opp, t):
+    # Neighbourhood mask, Zobrist key and evaluation of a position.
+    near = 0
+    key = 0
+    score = 0
+    for cell in cells_of(me):
+        near |= t.near[cell]
+        key ^= t.zobrist[0][cell]
+    for cell in cells_of(opp):
+        near |= t.near[cell]
+        key ^= t.zobrist[1][cell]
+    for window in t.all_windows:
+        mine, theirs = me & window, opp & window
+        if mine and not theirs:
+            score += t.weights[mine.bit_count()]
+        elif theirs and not mine:
+            score -= t.weights[theirs.bit_count()]
+    return near, key, score
+
+def root_moves(me, opp, geo):
+    # Root candidates (wire cell numbers), most promising first.
+    t = tables(geo)
+    stones = me | opp
+    if not stones:
+        return [geo.cells // 2 + 1]
+    near = 0
+    for cell in cells_of(stones):
+        near |= t.near[cell]
+    moves = ordered(me, opp, near & geo.full & ~stones, t)
+    return [cell + 1 for _, cell in moves[:ROOT_BRANCH]]
+
+def split(moves, parts):
+    # Round-robin, so every part gets some of the most promising moves.
+    return [moves[i::parts] for i in range(min(parts, len(moves)))]
+
+def search_root(me, opp, size, k, moves, deadline):
+    # Iterative deepening over the given root moves until `deadline`
+    # (time.monotonic(), so it means the same in every process). Returns
+    # (depth, score, cell) for the best move of every completed depth. Depth 1
+    # always completes. Takes plain ints so it can run in a process pool.
+    t = tables(geometry(size, k))
+    near, key, score = position(me, opp, t)
+    moves = [cell - 1 for cell in moves]
+    results = []
+    stones = (me | opp).bit_count()
+    for depth in range(1, min(MAX_DEPTH, size * size - stones) + 1):
+        searcher = Searcher(t, deadline if depth > 1 else None)
+        alpha, best_cell = -WIN - 1, moves[0]
+        try:
+            for cell in moves:
+                mine = gain(me, opp, t.windows[cell], t.weights)
+                if mine >= WIN // 2:
+                    value = WIN
+                elif depth == 1:
+                    value = score + mine
+                else:
+                    value = -searcher.negamax(opp, me | 1 << cell, near | t.near[cell],
+                                              key ^ t.zobrist[0][cell] ^ t.turn_key,
+                                              -(score + mine), depth - 1, -WIN - 1, -alpha, 1)
+                if value > alpha:
+                    alpha, best_cell = value, cell
+        except Timeout:
+            break
+        results.append((depth, alpha, best_cell + 1))
+        if abs(alpha) >= WIN // 2:
+            # Won or lost whatever happens; deeper search changes nothing.
+            break
+        # The best move so far is searched first at the next depth.
+        moves.remove(best_cell)
+        moves.insert(0, best_cell)
+    return results
+
+def pick(results):
+    # Best move from the search_root() results of every part: a forced win if
+    # any part found one, otherwise the best score at the deepest depth that
+    # every part completed. Parts whose moves all lose stop early and are
+    # left out unless every part lost.
+    for r in results:
+        if r[-1][1] >= WIN // 2:
+            return r[-1][2]
+    alive = [r for r in results if r[-1][1] > -WIN // 2] or results
+    depth = min(len(r) for r in alive)
+    return max((r[depth - 1] for r in alive), key=lambda result: result[1])[2]
+
+def best_move(me, opp, geo, budget=SEARCH_BUDGET, pool=None, parts=1):
+    # Blocking search. With a concurrent.futures pool the root moves are split
+    # into `parts` tasks searched in parallel.
+    moves = root_moves(me, opp, geo)
+    if len(moves) == 1:
+        return moves[0]
+    deadline = time.monotonic() + budget
+    if pool is None:
+        return pick([search_root(me, opp, geo.size, geo.k, moves, deadline)])
+    futures = [pool.submit(search_root, me, opp, geo.size, geo.k, part, deadline) for part in split(moves, parts)]
+    return pick([future.result() for future in futures])
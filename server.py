@@ -1,42 +1,40 @@
+import itertools
 import socket
-import sys
+import threading
+from collections import Counter, deque
+from time import perf_counter
 
-def init_board():
-    return [[str(j * 3 + i + 1) for i in range(3)] for j in range(3)]
+import metrics
+import protocol
+from engine import SIZE, Board, init_board, apply_move, check_victory, is_draw, board_rows
+from net import FramedConnection, ProtocolError
 
-def board_to_string(board):
-    return '\n'.join([' | '.join(row) for row in board])
+MOVE_TIMEOUT = 60.0
+METRICS_PORT = 9151 # Prometheus metrics on 127.0.0.1; 0 disables them
 
-def display_board(board):
-    print(board_to_string(board))
-    print()
+# Rooms run in their own threads, so the counters and the histogram are
+# updated under a lock.
+STATS = Counter()
+STATS_LOCK = threading.Lock()
+MOVE_SECONDS = metrics.Histogram()
 
-def check_victory(board, sign):
-    for row in board:
-        if all(cell == sign for cell in row): return True
-    for col in range(3):
-        if all(board[row][col] == sign for row in range(3)): return True
-    if all(board[i][i] == sign for i in range(3)): return True
-    if all(board[i][2 - i] == sign for i in range(3)): return True
-    return False
+def count(key, n=1):
+    with STATS_LOCK:
+        STATS[key] += n
 
-def is_draw(board):
-    return all(cell in ['X', 'O'] for row in board for cell in row)
-
-def apply_move(board, move, sign):
-    try:
-        move = int(move)
-        row, col = divmod(move - 1, 3)
-        if 0 <= row < 3 and 0 <= col < 3 and board[row][col] not in ['X', 'O']:
-            board[row][col] = sign
-            return True
-        return False
-    except (ValueError, TypeError):
-        return False
+def collect_metrics():
+    with STATS_LOCK:
+        stats = dict(STATS)
+        histograms = {'move_seconds': MOVE_SECONDS.snapshot()}
+    return metrics.render(stats, metrics.merge_snapshots([histograms]))
 
 def send(conn, msg):
+    # Lines are batched per turn and written by flush().
+    conn.queue(msg)
+
+def flush(conn):
     try:
-        conn.sendall((msg + '\n').encode())
+        conn.flush()
     except (BrokenPipeError, ConnectionResetError):
         print("Connection lost while sending.")
         raise
@@ -45,100 +43,284 @@ def send(conn, msg):
         raise
 
 def safe_recv(conn):
+    flush(conn)
     try:
-        conn.settimeout(60.0)  # 60 second timeout
-        data = conn.recv(1024)
-        if not data:
-            raise ConnectionResetError("Client disconnected.")
-        return data.decode().strip()
+        return conn.recv_line(MOVE_TIMEOUT)
     except socket.timeout:
+        count('timeouts')
         print("Timeout while waiting for client response")
         raise
+    except ProtocolError as e:
+        print(f"Error receiving data: {e}")
+        raise ConnectionResetError(str(e))
     except Exception as e:
         print(f"Error receiving data: {e}")
         raise
-    finally:
-        conn.settimeout(None)
 
 def send_board(conn, board):
-    for row in board:
-        send(conn, ' | '.join(row))
+    for row in board_rows(board, numbered=True):
+        send(conn, row)
+
+def recv_move_frame(conn):
+    flush(conn)
+    try:
+        kind, _, cell, seen, _ = protocol.unpack(conn.recv_exact(protocol.FRAME.size, MOVE_TIMEOUT))
+    except socket.timeout:
+        count('timeouts')
+        print("Timeout while waiting for client response")
+        conn.queue_bytes(protocol.pack_timeout())
+        raise
+    except ProtocolError as e:
+        print(f"Error receiving data: {e}")
+        raise ConnectionResetError(str(e))
+    if kind != protocol.FRAME_MOVE:
+        raise ConnectionResetError(f"Unexpected frame type {kind}")
+    return cell, seen
+
+# Player vs player: every connection does the usual handshake (3x3 board and
+# prompt, then an optional HELLO) and waits for an opponent who asked for the
+# same board. Each player speaks the unchanged client protocol as if it were
+# the only client and its opponent were the server: its stones are O, the
+# opponent's moves come back as the server's moves, and "Server wins!" means
+# the opponent won. The player who waited longer moves first. A compact
+# second player gets the first player's move as a reply with no move of its
+# own (cell 0). Its first move counts only once the MOVE frame shows it has
+# seen that move; one sent before (as a client that moves as soon as it is
+# welcomed does) is dropped, and the client moves again. A text client sees
+# the move on its next board.
+
+class Player:
+    __slots__ = ('conn', 'addr', 'version', 'sign', 'pending', 'last_move', 'opening')
+
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.version = protocol.TEXT_VERSION
+        self.sign = 'O'
+        # A text client without HELLO answers the first prompt with its move.
+        self.pending = None
+        # This player's last accepted move, 0 before its first one.
+        self.last_move = 0
+        # The opponent's move this player must have seen before its first
+        # one; 0 for the player who opens.
+        self.opening = 0
+
+    @property
+    def compact(self):
+        return self.version == protocol.COMPACT_VERSION
+
+    def view(self, board):
+        # The board as this player sees it: its own stones are O.
+        return board if self.sign == 'O' else Board(board.o, board.x, board.geo)
+
+    def result(self, result, mover):
+        # A result from the point of view of the player who just moved.
+        if self is mover or result not in (protocol.RESULT_CLIENT_WIN, protocol.RESULT_SERVER_WIN):
+            return result
+        return protocol.RESULT_SERVER_WIN if result == protocol.RESULT_CLIENT_WIN else protocol.RESULT_CLIENT_WIN
+
+# Players waiting for an opponent, by (size, k), oldest first.
+QUEUES = {}
+QUEUE_LOCK = threading.Lock()
+ROOM_IDS = itertools.count(1)
+
+def handshake(player):
+    # Returns the (size, k) the player asked for.
+    conn = player.conn
+    send_board(conn, init_board())
+    send(conn, protocol.PROMPT)
+    line = safe_recv(conn)
+    requested = protocol.parse_hello(line)
+    if requested is None:
+        player.pending = line
+        return SIZE, SIZE
+    version, size, k = requested
+    player.version = protocol.negotiate(version)
+    size, k = protocol.choose_board(size, k)
+    send(conn, protocol.welcome(player.version, MOVE_TIMEOUT, size, k))
+    if not player.compact and (size, k) != (SIZE, SIZE):
+        send_board(conn, init_board(size, k))
+    flush(conn)
+    return size, k
+
+def find_opponent(player, shape):
+    # O(1): take the oldest waiting player for this board, skipping any that
+    # hung up while they waited, or queue this one.
+    with QUEUE_LOCK:
+        waiting = QUEUES.get(shape)
+        while waiting:
+            opponent = waiting.popleft()
+            count('queued', -1)
+            if not opponent.conn.peer_closed():
+                return opponent
+            leave(opponent)
+        QUEUES.setdefault(shape, deque()).append(player)
+        count('queued')
+        return None
+
+def leave(player):
+    player.conn.close()
+    with STATS_LOCK:
+        STATS['active'] -= 1
+        STATS['disconnects'] += 1
+        STATS['bytes_in'] += player.conn.bytes_in
+        STATS['bytes_out'] += player.conn.bytes_out
+    print(f"Client {player.addr} disconnected")
+
+def read_move(player, board):
+    # The player's next legal move; invalid ones are answered and retried.
+    conn = player.conn
+    while True:
+        if player.compact:
+            move, seen = recv_move_frame(conn)
+            if not player.last_move and seen != player.opening:
+                # Made before the opening move reached the player.
+                continue
+        elif player.pending is not None:
+            move, player.pending = player.pending, None
+        else:
+            send(conn, protocol.prompt(board.geo.cells))
+            move = safe_recv(conn)
+        if apply_move(board, move, player.sign):
+            return int(move)
+        if player.compact:
+            conn.queue_bytes(protocol.pack_invalid(move, MOVE_TIMEOUT))
+        else:
+            send(conn, "Invalid move!")
+
+def report_own_move(player, board, move, result):
+    # In the compact protocol the player's move is only reported on its own
+    # when it ends the game; otherwise it rides along with the opponent's reply.
+    if player.compact:
+        if result != protocol.RESULT_CONTINUE:
+            player.conn.queue_bytes(protocol.pack_reply(result, move))
+        return
+    send(player.conn, "MOVE_ACCEPTED")
+    send_board(player.conn, player.view(board))
+    send(player.conn, protocol.RESULT_TEXT.get(result, "Server's turn"))
+
+def report_opponent_move(player, board, move, result):
+    if player.compact:
+        deadline = MOVE_TIMEOUT if result == protocol.RESULT_CONTINUE else 0
+        if not player.last_move:
+            player.opening = move
+        player.conn.queue_bytes(protocol.pack_reply(result, player.last_move, move, deadline))
+        return
+    if not player.last_move:
+        # Still waiting for its first prompt, which is all it expects.
+        return
+    send_board(player.conn, player.view(board))
+    send(player.conn, protocol.RESULT_TEXT.get(result, "CONTINUE"))
+
+def deliver(*players):
+    # Flushes every player; returns the first one whose connection failed.
+    for player in players:
+        try:
+            flush(player.conn)
+        except OSError:
+            return player
+    return None
+
+def play_room(room, players, board):
+    # players[0] moves first. Returns the result for players[0].
+    turn = 0
+    while True:
+        mover, other = players[turn], players[1 - turn]
+        try:
+            move = read_move(mover, board)
+        except OSError:
+            # Disconnected or out of time: the opponent wins.
+            deliver(mover)
+            return forfeit(room, other, board, players)
+        started = perf_counter()
+        mover.last_move = move
+        if check_victory(board, mover.sign, move):
+            result = protocol.RESULT_CLIENT_WIN
+        elif is_draw(board):
+            result = protocol.RESULT_DRAW
+        else:
+            result = protocol.RESULT_CONTINUE
+        report_own_move(mover, board, move, result)
+        report_opponent_move(other, board, move, other.result(result, mover))
+        gone = deliver(mover, other)
+        with STATS_LOCK:
+            MOVE_SECONDS.observe(perf_counter() - started)
+        if gone is not None and result == protocol.RESULT_CONTINUE:
+            return forfeit(room, other if gone is mover else mover, board, players)
+        if result != protocol.RESULT_CONTINUE:
+            print(f"Room {room}: {'draw' if result == protocol.RESULT_DRAW else f'{mover.addr} wins'}")
+            return players[0].result(result, mover)
+        turn = 1 - turn
+
+def forfeit(room, winner, board, players):
+    print(f"Room {room}: {winner.addr} wins, the opponent left")
+    if winner.compact:
+        winner.conn.queue_bytes(protocol.pack_reply(protocol.RESULT_CLIENT_WIN, winner.last_move))
+    else:
+        if winner.last_move:
+            send_board(winner.conn, winner.view(board))
+        send(winner.conn, protocol.RESULT_TEXT[protocol.RESULT_CLIENT_WIN])
+    deliver(winner)
+    return players[0].result(protocol.RESULT_CLIENT_WIN, winner)
+
+def run_room(first, second, shape):
+    room = next(ROOM_IDS)
+    count('rooms')
+    print(f"Room {room}: {first.addr} vs {second.addr}")
+    first.sign, second.sign = 'O', 'X'
+    board = init_board(*shape)
+    try:
+        result = play_room(room, (first, second), board)
+    except Exception as e:
+        print(f"Room {room}: unexpected error: {e}")
+        result = None
+    key = {
+        protocol.RESULT_CLIENT_WIN: 'first_wins',
+        protocol.RESULT_SERVER_WIN: 'second_wins',
+        protocol.RESULT_DRAW: 'draws',
+    }.get(result, 'unfinished')
+    with STATS_LOCK:
+        STATS['games'] += 1
+        STATS[key] += 1
+        STATS['rooms'] -= 1
+    leave(first)
+    leave(second)
+
+def serve_player(sock, addr):
+    # Runs in a short-lived thread per connection; the thread that completes
+    # a pair goes on to run the room.
+    player = Player(FramedConnection(sock), addr)
+    print(f"Connected to {addr}")
+    try:
+        shape = handshake(player)
+    except OSError:
+        print("Client disconnected or timed out")
+        leave(player)
+        return
+    opponent = find_opponent(player, shape)
+    if opponent is None:
+        print(f"{addr} is waiting for an opponent")
+        return
+    run_room(opponent, player, shape)
 
 HOST = '0.0.0.0'
 PORT = 65432
 
 try:
+    if METRICS_PORT:
+        metrics.start_server(METRICS_PORT, collect_metrics)
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((HOST, PORT))
         s.listen()
-        print("Waiting for a player...")
-        conn, addr = s.accept()
-
-        with conn:
-            print(f"Connected to {addr}")
-            board = init_board()
-            send_board(conn, board)
-
-            while True:
-                send(conn, "Your move (1-9):")
-                try:
-                    move = safe_recv(conn)
-                except (ConnectionResetError, socket.timeout):
-                    print("Client disconnected or timed out")
-                    break
-
-                if not apply_move(board, move, 'O'):
-                    send(conn, "Invalid move!")
-                    continue
-
-                if check_victory(board, 'O'):
-                    send(conn, "MOVE_ACCEPTED")
-                    send_board(conn, board)
-                    send(conn, "You win!")
-                    display_board(board)
-                    print("Client wins!")
-                    break
-
-                if is_draw(board):
-                    send(conn, "MOVE_ACCEPTED")
-                    send_board(conn, board)
-                    send(conn, "Draw!")
-                    display_board(board)
-                    print("Draw!")
-                    break
-
-                send(conn, "MOVE_ACCEPTED")
-                send_board(conn, board)
-
-                send(conn, "Server's turn")
-                display_board(board)
-
-                while True:
-                    try:
-                        move = input("Your move (1-9): ").strip()
-                    except KeyboardInterrupt:
-                        print("\nServer interrupted.")
-                        sys.exit(0)
-                    if apply_move(board, move, 'X'):
-                        break
-                    print("Invalid move. Try again.")
-
-                send_board(conn, board)
-
-                if check_victory(board, 'X'):
-                    send(conn, "Server wins!")
-                    display_board(board)
-                    print("You win!")
-                    break
-                elif is_draw(board):
-                    send(conn, "Draw!")
-                    print("Draw!")
-                    break
-                else:
-                    send(conn, "CONTINUE")
+        print("Waiting for players...")
+        while True:
+            sock, addr = s.accept()
+            count('accepted')
+            count('active')
+            threading.Thread(target=serve_player, args=(sock, addr), daemon=True).start()
 
 except KeyboardInterrupt:
     print("\nServer shut down manually.")
 except Exception as e:
-    print(f"Unexpected error: {e}")
\ No newline at end of file
+    print(f"Unexpected error: {e}")
@@ -1,168 +1,915 @@
+import argparse
+import asyncio
+import itertools
+import secrets
+import signal
 import socket
-import random
 import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from time import perf_counter
 
-def init_board():
-    return [[" " for _ in range(3)] for _ in range(3)]
+import ai
+import journal
+import metrics
+import protocol
+import ratings
+import search
+from net import FramedProtocol, ProtocolError
+from scheduler import DeadlineScheduler
+from supervisor import Supervisor
+from engine import (MAX_SIZE, Board, init_board, apply_move, check_victory, is_draw, board_cells, board_rows,
+                    board_to_string)
 
-def board_to_string(board):
-    return '\n'.join([' | '.join(row) for row in board])
+THINK_DELAY = 0.5
+MOVE_TIMEOUT = 60.0
+DRAIN_TIMEOUT = 30.0
+METRICS_PORT = 9150
+# Bytes a spectator may have unsent before it counts as slow.
+WATCH_BUFFER = 64 * 1024
+SLOW_WATCHERS = ('latest', 'drop')
+# Admission control: players beyond --max-sessions wait in a queue of
+# --queue-size or are turned away; each player may send RATE messages per
+# second with bursts of BURST (humans never get close, bots in --benchmark
+# mode are not limited); a player with more than WRITE_LIMIT bytes of
+# replies unread is disconnected.
+BACKLOG = 1024
+WHEN_FULL = ('queue', 'reject')
+QUEUE_SIZE = 1000
+RATE = 100.0
+BURST = 200
+WRITE_LIMIT = 64 * 1024
+# A player whose connection drops mid-game can resume it for RESUME_TTL
+# seconds; at most MAX_ORPHANS such games are kept, the oldest go first.
+RESUME_TTL = 60.0
+MAX_ORPHANS = 10000
+QUIET = False
+
+# Per-process counters; in pre-fork mode each worker reports them to the supervisor.
+STATS = Counter()
+MOVE_SECONDS = metrics.Histogram()
+AI_SECONDS = metrics.Histogram()
+HISTOGRAMS = {'move_seconds': MOVE_SECONDS, 'ai_seconds': AI_SECONDS}
+# Players by session id, oldest first.
+SESSIONS = {}
+# Connections that found the server full, until their first line shows
+# whether they need a slot: WATCH, RESUME and LEADERBOARD go ahead without one.
+ARRIVALS = set()
+# Players waiting for a free slot, with their first line buffered and
+# reading paused.
+WAITING = deque()
+# Games in progress whose player dropped, by resume token, oldest first.
+ORPHANS = {}
+SESSION_IDS = itertools.count(1)
+# Set by serve() on shutdown: games in progress may finish, no new ones start.
+DRAINING = False
+# Set by serve() when --journal and --ratings are given.
+JOURNAL = None
+RATINGS = None
+# Processes that search boards bigger than 3x3; set by serve() when the
+# level searches.
+SEARCH_POOL = None
+RESULT_KEYS = {
+    protocol.RESULT_CLIENT_WIN: 'client_wins',
+    protocol.RESULT_SERVER_WIN: 'server_wins',
+    protocol.RESULT_DRAW: 'draws',
+}
+
+def log(msg):
+    if not QUIET:
+        print(msg)
 
 def display_board(board):
-    print(board_to_string(board))
-    print()
+    log(board_to_string(board) + '\n')
 
-def get_available_moves(board):
-    return [i + 1 for i, cell in enumerate(sum(board, [])) if cell not in ['X', 'O']]
+# Whose move it is; GAME_OVER sessions wait for NEW_GAME.
+CLIENT_TURN = 0
+SERVER_TURN = 1
+GAME_OVER = 2
+QUEUED = 3
+ARRIVING = 4
 
-def check_victory(board, sign):
-    for row in board:
-        if all(cell == sign for cell in row): return True
-    for col in range(3):
-        if all(board[row][col] == sign for row in range(3)): return True
-    if all(board[i][i] == sign for i in range(3)): return True
-    if all(board[i][2 - i] == sign for i in range(3)): return True
-    return False
+class GameSession(FramedProtocol):
+    # Everything the server keeps per player: the connection, the board as two
+    # bitmasks, whose turn it is, the pending deadline and the score. The
+    # session is driven by incoming data and timer callbacks, so an idle
+    # player costs no task or coroutine frame.
+    __slots__ = ('session_id', 'scheduler', 'config', 'board', 'turn', 'deadline', 'version', 'greeted',
+                 'pending_move', 'client_wins', 'server_wins', 'draws', 'watchers', 'tokens', 'refilled',
+                 'resume_token', 'player')
 
-def is_draw(board):
-    return all(cell in ['X', 'O'] for row in board for cell in row)
+    def __init__(self, scheduler, config):
+        super().__init__()
+        self.session_id = next(SESSION_IDS)
+        self.scheduler = scheduler
+        self.config = config
+        self.board = init_board()
+        self.turn = CLIENT_TURN
+        # Move deadline from the shared scheduler, or the think-delay timer.
+        self.deadline = None
+        self.version = protocol.TEXT_VERSION
+        self.greeted = False
+        self.pending_move = 0
+        self.client_wins = 0
+        self.server_wins = 0
+        self.draws = 0
+        # Spectators of this game; a set once the first one arrives.
+        self.watchers = None
+        # Token bucket for incoming messages; refilled is set by the first one.
+        self.tokens = config.burst
+        self.refilled = None
+        # Sent in WELCOME; None when the game cannot be resumed.
+        self.resume_token = None
+        # The named player's ratings.Player; None when anonymous or unrated.
+        self.player = None
 
-def apply_move(board, move, sign):
-    try:
-        move = int(move)
-        row, col = divmod(move - 1, 3)
-        if 0 <= row < 3 and 0 <= col < 3 and board[row][col] not in ['X', 'O']:
-            board[row][col] = sign
+    @property
+    def addr(self):
+        return self.transport.get_extra_info('peername')
+
+    @property
+    def compact(self):
+        return self.version == protocol.COMPACT_VERSION
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        STATS['accepted'] += 1
+        transport.set_write_buffer_limits(high=self.config.write_limit)
+        limit = self.config.max_sessions
+        if limit and len(SESSIONS) >= limit:
+            if len(ARRIVALS) >= self.config.queue_size:
+                self.reject()
+                return
+            self.turn = ARRIVING
+            # Buffer only, until classify() has seen the first line.
+            self.receiving = False
+            ARRIVALS.add(self)
+            self.arm_deadline()
+            return
+        self.admit()
+
+    def reject(self):
+        STATS['rejected_full'] += 1
+        self.turn = GAME_OVER
+        self.queue("Server is full, try again later")
+        self.close()
+
+    def admit(self):
+        SESSIONS[self.session_id] = self
+        STATS['active'] += 1
+        log(f"Connected to {self.addr} (game {self.session_id})")
+        if JOURNAL is not None:
+            JOURNAL.record(self.session_id, journal.OPEN)
+        self.start_game()
+        self.flush()
+
+    def connection_lost(self, exc):
+        if self.turn == ARRIVING:
+            ARRIVALS.discard(self)
+            self.cancel_deadline()
+            return
+        if self.turn == QUEUED:
+            WAITING.remove(self)
+            STATS['waiting'] -= 1
+            return
+        if self.session_id not in SESSIONS:
+            # Turned away before it was admitted.
+            return
+        self.cancel_deadline()
+        STATS['disconnects'] += 1
+        SESSIONS.pop(self.session_id, None)
+        STATS['active'] -= 1
+        log(f"Client {self.addr} disconnected")
+        admit_waiting(self.config.max_sessions)
+        if self.resume_token is not None and self.turn != GAME_OVER:
+            self.orphan()
+            return
+        self.end_session()
+
+    def end_session(self):
+        if JOURNAL is not None:
+            JOURNAL.record(self.session_id, journal.CLOSE)
+        if self.turn != GAME_OVER:
+            STATS['unfinished'] += 1
+            log("Client disconnected or timed out")
+        if self.watchers:
+            self.publish(None)
+            for watcher in list(self.watchers):
+                watcher.close()
+
+    def orphan(self):
+        # The game stays as it is, spectators included, until the player
+        # resumes it or it expires. A server move that was being thought
+        # about is made again on resume.
+        self.buffer.data.clear()
+        self.outgoing.clear()
+        ORPHANS[self.resume_token] = self
+        STATS['orphaned'] += 1
+        self.deadline = self.scheduler.schedule(self.config.resume_ttl, self.expire)
+        while len(ORPHANS) > self.config.max_orphans:
+            ORPHANS[next(iter(ORPHANS))].expire()
+
+    def expire(self):
+        self.cancel_deadline()
+        del ORPHANS[self.resume_token]
+        self.resume_token = None
+        STATS['orphaned'] -= 1
+        STATS['orphans_expired'] += 1
+        self.end_session()
+
+    def resume(self, transport, buffer):
+        # Takes over the new connection of the player who held this game.
+        self.cancel_deadline()
+        del ORPHANS[self.resume_token]
+        STATS['orphaned'] -= 1
+        STATS['resumed'] += 1
+        self.transport = transport
+        self.buffer = buffer
+        transport.set_protocol(self)
+        SESSIONS[self.session_id] = self
+        STATS['active'] += 1
+        log(f"Client {self.addr} resumed game {self.session_id}")
+        geo = self.board.geo
+        self.send(protocol.resumed(self.version, self.config.move_timeout, geo.size, geo.k, board_cells(self.board),
+                                   self.turn == SERVER_TURN))
+        if self.turn == SERVER_TURN:
+            self.think()
+        else:
+            self.arm_deadline()
+        self.flush()
+        self.dispatch()
+
+    def close(self):
+        # Closed by the server (timeout, rejection, shutdown): there is
+        # nothing to resume.
+        self.resume_token = None
+        super().close()
+
+    def data_received(self, data):
+        started = perf_counter()
+        STATS['bytes_in'] += len(data)
+        super().data_received(data)
+        if self.turn == ARRIVING:
+            self.classify()
+        MOVE_SECONDS.observe(perf_counter() - started)
+
+    def classify(self):
+        # Only players need a slot: spectators, resumed games (whose orphan
+        # might expire while they wait) and leaderboard requests go ahead.
+        line = self.buffer.peek_line()
+        if line is None:
+            if len(self.buffer.data) > self.buffer.max_line:
+                self.close()
+            return
+        ARRIVALS.discard(self)
+        self.cancel_deadline()
+        player = (protocol.parse_watch(line) is None and protocol.parse_resume(line) is None
+                  and protocol.parse_leaderboard(line) is None)
+        limit = self.config.max_sessions
+        if player and (WAITING or len(SESSIONS) >= limit):
+            if self.config.when_full == 'reject' or len(WAITING) >= self.config.queue_size:
+                self.reject()
+                return
+            self.turn = QUEUED
+            self.transport.pause_reading()
+            WAITING.append(self)
+            STATS['waiting'] += 1
+            return
+        self.turn = CLIENT_TURN
+        self.admit()
+        self.resume_receiving()
+
+    def flush(self):
+        sent = super().flush()
+        STATS['bytes_out'] += sent
+        return sent
+
+    def pause_writing(self):
+        # More than --write-limit bytes of replies unread: the player has
+        # stopped reading, and its buffer would only keep growing.
+        STATS['stalled_readers'] += 1
+        log(f"[{self.addr}] Not reading its replies, disconnecting")
+        self.resume_token = None
+        self.transport.abort()
+
+    def allow_message(self):
+        # Token bucket: false (and the connection closed) once the player
+        # sends faster than --rate messages per second for longer than the burst.
+        rate = self.config.rate
+        if not rate:
             return True
-        return False
-    except Exception as ex:
-        print(f"[apply_move] Error: {ex}")
-        return False
+        now = time.monotonic()
+        if self.refilled is not None:
+            self.tokens = min(self.config.burst, self.tokens + (now - self.refilled) * rate)
+        self.refilled = now
+        if self.tokens < 1:
+            STATS['rate_limited'] += 1
+            log(f"[{self.addr}] Too many messages, disconnecting")
+            self.close()
+            return False
+        self.tokens -= 1
+        return True
+
+    def on_error(self, exc):
+        if isinstance(exc, ProtocolError):
+            log(f"[{self.addr}] {exc}")
+        else:
+            print(f"Unexpected error in session {self.addr}: {exc}")
+        self.close()
+
+    def send(self, msg):
+        # Lines are batched and written once the current input is handled.
+        self.queue(msg)
+
+    def send_board(self):
+        for row in board_rows(self.board):
+            self.send(row)
+
+    def arm_deadline(self):
+        self.cancel_deadline()
+        self.deadline = self.scheduler.schedule(self.config.move_timeout, self.on_timeout)
+
+    def cancel_deadline(self):
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+
+    def on_timeout(self):
+        self.deadline = None
+        if self.turn == CLIENT_TURN:
+            STATS['timeouts'] += 1
+            log("Timeout while waiting for client response")
+            if self.compact:
+                self.queue_bytes(protocol.pack_timeout())
+        self.close()
+
+    def start_game(self):
+        self.board = Board(geo=self.board.geo)
+        self.pending_move = 0
+        if self.watchers:
+            self.publish(protocol.RESULT_CONTINUE)
+        if not self.compact:
+            self.send_board()
+        self.prompt()
+
+    def prompt(self):
+        self.turn = CLIENT_TURN
+        if not self.compact:
+            self.send(protocol.prompt(self.board.geo.cells))
+        self.arm_deadline()
+
+    def on_line(self, line):
+        if not self.allow_message():
+            return
+        if self.turn == GAME_OVER:
+            self.new_game(line == protocol.NEW_GAME)
+            return
+        if not self.greeted:
+            self.greeted = True
+            game = protocol.parse_watch(line)
+            if game is not None:
+                self.become_spectator(game)
+                return
+            token = protocol.parse_resume(line)
+            if token is not None:
+                self.resume_game(token)
+                return
+            count = protocol.parse_leaderboard(line)
+            if count is not None:
+                self.send_leaderboard(count)
+                return
+            requested = protocol.parse_hello(line)
+            if requested is not None:
+                version, size, k = requested
+                name = protocol.player_name(line)
+                if name is not None and RATINGS is not None:
+                    self.player = RATINGS.player(name)
+                self.version = protocol.negotiate(version)
+                size, k = protocol.choose_board(size, k, self.config.max_size)
+                self.board = init_board(size, k)
+                if self.config.resume_ttl:
+                    self.resume_token = secrets.randbits(63)
+                self.send(protocol.welcome(self.version, self.config.move_timeout, size, k, self.resume_token))
+                if JOURNAL is not None and not self.board.geo.classic:
+                    JOURNAL.record(self.session_id, journal.shape_event(size, k))
+                if self.compact:
+                    self.frame_size = protocol.FRAME.size
+                elif not self.board.geo.classic:
+                    # The 3x3 board sent on connect no longer applies.
+                    self.send_board()
+                self.prompt()
+                return
+        self.handle_move(line)
+
+    def on_frame(self, frame):
+        if not self.allow_message():
+            return
+        kind, _, cell, _, _ = protocol.unpack(frame)
+        if self.turn == GAME_OVER:
+            self.new_game(kind == protocol.FRAME_NEW_GAME)
+        elif kind == protocol.FRAME_MOVE:
+            self.handle_move(cell)
+        else:
+            log(f"[{self.addr}] Unexpected frame type {kind}")
+            self.close()
+
+    def reject_move(self, move):
+        if self.compact:
+            self.queue_bytes(protocol.pack_invalid(move, self.config.move_timeout))
+        else:
+            self.send("Invalid move!")
+
+    def report_client_move(self, move, result):
+        if JOURNAL is not None:
+            JOURNAL.record(self.session_id, move, result)
+        if self.watchers:
+            self.publish(result)
+        if self.compact:
+            # Unless the game is over, the client's move goes out together
+            # with the server's reply in a single frame.
+            if result == protocol.RESULT_CONTINUE:
+                self.pending_move = move
+            else:
+                self.queue_bytes(protocol.pack_reply(result, move))
+            return
+        self.send("MOVE_ACCEPTED")
+        self.send_board()
+        self.send(protocol.RESULT_TEXT.get(result, "Server's turn"))
+
+    def report_server_move(self, move, result):
+        if JOURNAL is not None:
+            JOURNAL.record(self.session_id, journal.SERVER_MOVE | move, result)
+        if self.watchers:
+            self.publish(result)
+        if self.compact:
+            deadline = self.config.move_timeout if result == protocol.RESULT_CONTINUE else 0
+            self.queue_bytes(protocol.pack_reply(result, self.pending_move, move, deadline))
+            return
+        self.send_board()
+        self.send(protocol.RESULT_TEXT.get(result, "CONTINUE"))
+
+    def result(self):
+        board = self.board
+        if check_victory(board, 'O'):
+            return protocol.RESULT_CLIENT_WIN
+        if check_victory(board, 'X'):
+            return protocol.RESULT_SERVER_WIN
+        if is_draw(board):
+            return protocol.RESULT_DRAW
+        return protocol.RESULT_CONTINUE
+
+    def board_update(self, result):
+        geo = self.board.geo
+        return (protocol.board_update(self.session_id, geo.size, geo.k, board_cells(self.board), result) + '\n').encode()
+
+    def publish(self, result):
+        # Encoded once, however many spectators there are.
+        data = self.board_update(result)
+        STATS['watch_updates'] += 1
+        for watcher in list(self.watchers):
+            watcher.deliver(data)
+
+    def retire(self):
+        # The connection stops being this player's: the session leaves
+        # SESSIONS and another protocol takes over the transport.
+        self.cancel_deadline()
+        self.receiving = False
+        self.turn = GAME_OVER
+        SESSIONS.pop(self.session_id, None)
+        STATS['active'] -= 1
+        if JOURNAL is not None:
+            JOURNAL.record(self.session_id, journal.CLOSE)
+        admit_waiting(self.config.max_sessions)
 
-def send(conn, msg):
+    def resume_game(self, token):
+        session = ORPHANS.get(token)
+        if session is None:
+            # No game was started on this connection either.
+            self.turn = GAME_OVER
+            self.queue("No such game")
+            self.close()
+            return
+        self.retire()
+        session.resume(self.transport, self.buffer)
+
+    def send_leaderboard(self, count):
+        # A snapshot the ratings thread keeps; the connection has no game to end.
+        self.turn = GAME_OVER
+        STATS['leaderboards'] += 1
+        leaders = RATINGS.leaderboard(count) if RATINGS is not None else ()
+        for rank, (name, wins, losses, draws, rating) in enumerate(leaders, 1):
+            self.queue(protocol.rank_line(rank, name, rating, wins, losses, draws))
+        self.close()
+
+    def become_spectator(self, game_id):
+        self.retire()
+        if not game_id and SESSIONS:
+            game_id = next(reversed(SESSIONS))
+        spectator = Spectator(self.config.slow_watchers)
+        self.transport.set_protocol(spectator)
+        spectator.connection_made(self.transport)
+        spectator.watch(SESSIONS.get(game_id))
+
+    def handle_move(self, move):
+        board = self.board
+        if not apply_move(board, move, 'O'):
+            self.reject_move(move)
+            self.prompt()
+            return
+        move = int(move)
+
+        if check_victory(board, 'O', move):
+            self.report_client_move(move, protocol.RESULT_CLIENT_WIN)
+            display_board(board)
+            log("Client wins!")
+            self.end_game(protocol.RESULT_CLIENT_WIN)
+            return
+
+        if is_draw(board):
+            self.report_client_move(move, protocol.RESULT_DRAW)
+            display_board(board)
+            log("Draw!")
+            self.end_game(protocol.RESULT_DRAW)
+            return
+
+        self.report_client_move(move, protocol.RESULT_CONTINUE)
+        self.think()
+
+    def think(self):
+        # Input that arrives while the server thinks waits in the buffer.
+        self.turn = SERVER_TURN
+        self.receiving = False
+        self.cancel_deadline()
+        if self.config.delay > 0:
+            # Cosmetic pause before the server's move; only this session waits.
+            self.flush()
+            self.deadline = asyncio.get_running_loop().call_later(self.config.delay, self.server_move)
+        else:
+            self.server_move()
+
+    def server_move(self):
+        self.deadline = None
+        board = self.board
+        searched = not board.geo.classic and ai.wants_search(self.config.level)
+        if searched and SEARCH_POOL is not None:
+            self.start_search()
+            return
+        try:
+            started = perf_counter()
+            move = ai.find_best_move(board, 'X', self.config.level, self.config.search_budget, searched)
+            AI_SECONDS.observe(perf_counter() - started)
+            self.play_server_move(move)
+        except Exception as e:
+            self.on_error(e)
+            return
+        self.resume_receiving()
+
+    def start_search(self):
+        # The search runs in the pool, split into --search-split parts, while
+        # the loop keeps serving other sessions. Its future takes the place of
+        # the deadline, so a disconnect cancels it.
+        board = self.board
+        geo = board.geo
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + self.config.search_budget
+        parts = search.split(search.root_moves(board.x, board.o, geo), self.config.search_split)
+        self.deadline = asyncio.gather(*(
+            loop.run_in_executor(SEARCH_POOL, search.search_root, board.x, board.o, geo.size, geo.k, part, deadline)
+            for part in parts
+        ))
+        self.deadline.add_done_callback(partial(self.search_done, perf_counter()))
+
+    def search_done(self, started, future):
+        if future.cancelled():
+            return
+        self.deadline = None
+        try:
+            move = search.pick(future.result())
+            AI_SECONDS.observe(perf_counter() - started)
+            self.play_server_move(move)
+        except Exception as e:
+            self.on_error(e)
+            return
+        self.resume_receiving()
+
+    def play_server_move(self, move):
+        board = self.board
+        apply_move(board, move, 'X')
+        if check_victory(board, 'X', move):
+            self.report_server_move(move, protocol.RESULT_SERVER_WIN)
+            display_board(board)
+            log("You win!")
+            self.end_game(protocol.RESULT_SERVER_WIN)
+        elif is_draw(board):
+            self.report_server_move(move, protocol.RESULT_DRAW)
+            log("Draw!")
+            self.end_game(protocol.RESULT_DRAW)
+        else:
+            self.report_server_move(move, protocol.RESULT_CONTINUE)
+            self.prompt()
+
+    def end_game(self, result):
+        key = RESULT_KEYS[result]
+        setattr(self, key, getattr(self, key) + 1)
+        STATS['games'] += 1
+        STATS[key] += 1
+        if self.player is not None:
+            # Memory only; the store writes it out in the background.
+            RATINGS.record(self.player, self.config.level, result)
+            STATS['rated_games'] += 1
+        self.turn = GAME_OVER
+        if DRAINING:
+            # close() still sends the result.
+            self.close()
+            return
+        # Wait for a rematch with the same timeout as a move.
+        self.arm_deadline()
+
+    def new_game(self, requested):
+        # Games repeat on the same connection for as long as the client
+        # asks for a rematch with NEW_GAME.
+        if not requested or DRAINING:
+            self.close()
+            return
+        STATS['rematches'] += 1
+        score = self.player.score() if self.player is not None else (self.client_wins, self.server_wins, self.draws)
+        if self.compact:
+            self.queue_bytes(protocol.pack_new_game(*score))
+        else:
+            self.send(protocol.score_line(*score))
+        self.start_game()
+
+class Spectator(FramedProtocol):
+    # A connection that asked to WATCH a game. It gets the BOARD line of every
+    # update until the game's player leaves, and its input is ignored. Once
+    # more than WATCH_BUFFER bytes are unsent, the transport pauses writing:
+    # with 'latest' only the newest update is kept and written when the
+    # spectator catches up, with 'drop' the spectator is disconnected.
+    __slots__ = ('policy', 'game', 'latest', 'stalled')
+
+    def __init__(self, policy='latest'):
+        super().__init__()
+        self.policy = policy
+        self.game = None
+        self.latest = None
+        self.stalled = False
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        transport.set_write_buffer_limits(high=WATCH_BUFFER)
+        STATS['spectators'] += 1
+
+    def watch(self, game):
+        if game is None:
+            self.queue("No such game")
+            self.close()
+            return
+        self.game = game
+        if game.watchers is None:
+            game.watchers = set()
+        game.watchers.add(self)
+        self.queue(protocol.watching(game.session_id))
+        self.queue_bytes(game.board_update(game.result()))
+        self.flush()
+
+    def deliver(self, data):
+        if self.stalled:
+            if self.policy == 'drop':
+                self.game.watchers.discard(self)
+                STATS['watchers_dropped'] += 1
+                self.transport.abort()
+                return
+            self.latest = data
+            STATS['watch_skipped'] += 1
+            return
+        self.transport.write(data)
+        STATS['watch_sent'] += 1
+        STATS['bytes_out'] += len(data)
+
+    def pause_writing(self):
+        self.stalled = True
+
+    def resume_writing(self):
+        self.stalled = False
+        if self.latest is not None and not self.transport.is_closing():
+            data, self.latest = self.latest, None
+            self.deliver(data)
+
+    def data_received(self, data):
+        STATS['bytes_in'] += len(data)
+
+    def flush(self):
+        sent = super().flush()
+        STATS['bytes_out'] += sent
+        return sent
+
+    def connection_lost(self, exc):
+        if self.game is not None and self.game.watchers:
+            self.game.watchers.discard(self)
+        STATS['spectators'] -= 1
+
+def admit_waiting(limit):
+    # Oldest first, skipping any that gave up while they waited.
+    while WAITING and (not limit or len(SESSIONS) < limit):
+        session = WAITING.popleft()
+        STATS['waiting'] -= 1
+        session.turn = CLIENT_TURN
+        if session.transport.is_closing():
+            continue
+        session.transport.resume_reading()
+        session.admit()
+        # Its first line may already be buffered.
+        session.resume_receiving()
+
+def listen_socket(host, port, reuse_port=False, backlog=BACKLOG):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Every worker binds the same port; the kernel spreads new connections between them.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+async def drain_sessions(timeout):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    # Players sitting between games, or still waiting for a slot, have
+    # nothing left to finish.
+    for session in list(WAITING) + list(ARRIVALS):
+        session.close()
+    for session in list(SESSIONS.values()):
+        if session.turn == GAME_OVER:
+            session.close()
+    if SESSIONS:
+        print(f"Waiting for {len(SESSIONS)} game(s) to finish...")
+    while SESSIONS and loop.time() < deadline:
+        await asyncio.sleep(0.1)
+    for session in list(SESSIONS.values()):
+        session.close()
+    for session in list(ORPHANS.values()):
+        session.expire()
+
+async def report_stats(stats_queue, index):
+    while True:
+        stats_queue.put((index, dict(STATS), metrics.snapshot_all(HISTOGRAMS)))
+        await asyncio.sleep(1.0)
+
+def collect_metrics():
+    return metrics.render(dict(STATS), metrics.merge_snapshots([metrics.snapshot_all(HISTOGRAMS)]))
+
+async def serve(config, stats_queue=None, index=0):
+    global JOURNAL, RATINGS, SEARCH_POOL, DRAINING
+    loop = asyncio.get_running_loop()
+    sock = listen_socket(config.host, config.port, reuse_port=config.workers != 1, backlog=config.backlog)
+    scheduler = DeadlineScheduler()
+    if config.level in ('hard', 'perfect') and config.max_size > 3:
+        # Ctrl-C is for this process; the pool goes down with it.
+        SEARCH_POOL = ProcessPoolExecutor(config.search_workers or None, initializer=signal.signal,
+                                          initargs=(signal.SIGINT, signal.SIG_IGN))
+        # Start the processes now, before the journal and metrics threads exist.
+        SEARCH_POOL.submit(int).result()
+    server = await loop.create_server(lambda: GameSession(scheduler, config), sock=sock)
+    stop = asyncio.Event()
     try:
-        conn.sendall((msg + '\n').encode())
-    except (BrokenPipeError, ConnectionResetError):
-        print("Connection lost while sending.")
-        raise
-    except Exception as e:
-        print(f"Error sending data: {e}")
-        raise
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+    except NotImplementedError:
+        pass
+    reporter = loop.create_task(report_stats(stats_queue, index)) if stats_queue is not None else None
+    # In pre-fork mode the supervisor serves the combined metrics instead.
+    if stats_queue is None and config.metrics_port:
+        metrics.start_server(config.metrics_port, collect_metrics)
+    if config.journal:
+        JOURNAL = journal.JournalWriter(config.journal if stats_queue is None else journal.worker_path(config.journal, index))
+    if config.ratings:
+        # One database for all workers; each keeps its own cache.
+        RATINGS = ratings.RatingStore(config.ratings)
+    print("Server started. Waiting for players...")
 
-def safe_recv(conn):
     try:
-        conn.settimeout(60.0)
-        data = conn.recv(1024)
-        if not data:
-            print("[safe_recv] Client disconnected.")
-            return None
-        return data.decode().strip()
-    except socket.timeout:
-        print("Timeout while waiting for client response")
-        return None
-    except Exception as e:
-        print(f"Error receiving data: {e}")
-        return None
+        await stop.wait()
+        # Stop accepting, then give games in progress a chance to end.
+        server.close()
+        DRAINING = True
+        await drain_sessions(config.drain_timeout)
     finally:
-        conn.settimeout(None)
-
-def send_board(conn, board):
-    for row in board:
-        send(conn, ' | '.join(row))
-
-def find_best_move(board):
-    moves = get_available_moves(board)
-    if random.random() < 0.1:
-        return random.choice(moves)
-    for move in moves:
-        temp = [row[:] for row in board]
-        apply_move(temp, move, 'X')
-        if check_victory(temp, 'X'):
-            return move
-    for move in moves:
-        temp = [row[:] for row in board]
-        apply_move(temp, move, 'O')
-        if check_victory(temp, 'O'):
-            return move
-    if board[1][1] == ' ':
-        return 5
-    for move in [1, 3, 7, 9]:
-        row, col = divmod(move - 1, 3)
-        if board[row][col] == ' ':
-            return move
-    return random.choice(moves)
+        if JOURNAL is not None:
+            JOURNAL.close()
+            JOURNAL = None
+        if RATINGS is not None:
+            RATINGS.close()
+            RATINGS = None
+        if SEARCH_POOL is not None:
+            SEARCH_POOL.shutdown(wait=False, cancel_futures=True)
+            SEARCH_POOL = None
+    if reporter is not None:
+        reporter.cancel()
+        stats_queue.put((index, dict(STATS), metrics.snapshot_all(HISTOGRAMS)))
+
+def run_worker(index, stats_queue, config):
+    global QUIET
+    QUIET = config.benchmark
+    # Ctrl-C reaches the whole process group; only the supervisor acts on it.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve(config, stats_queue, index))
 
 HOST = '0.0.0.0'
 PORT = 65432
 
-try:
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((HOST, PORT))
-        s.listen()
-        print("Server started. Waiting for players...")
-
-        while True:
-            print("Waiting for a player...")
-            s.settimeout(60.0)
-            try:
-                conn, addr = s.accept()
-            except socket.timeout:
-                print("No client connected for 60 seconds. Server shutting down.")
-                break
-            with conn:
-                print(f"Connected to {addr}")
-                board = init_board()
-                send_board(conn, board)
-
-                while True:
-                    send(conn, "Your move (1-9):")
-                    move = safe_recv(conn)
-                    if move is None:
-                        print("Client disconnected or timed out")
-                        break
-
-                    if not apply_move(board, move, 'O'):
-                        send(conn, "Invalid move!")
-                        continue
-
-                    if check_victory(board, 'O'):
-                        send(conn, "MOVE_ACCEPTED")
-                        send_board(conn, board)
-                        send(conn, "You win!")
-                        display_board(board)
-                        print("Client wins!")
-                        break
-
-                    if is_draw(board):
-                        send(conn, "MOVE_ACCEPTED")
-                        send_board(conn, board)
-                        send(conn, "Draw!")
-                        display_board(board)
-                        print("Draw!")
-                        break
-
-                    send(conn, "MOVE_ACCEPTED")
-                    send_board(conn, board)
-                    send(conn, "Server's turn")
-                    time.sleep(0.5)
-                    move = find_best_move(board)
-                    apply_move(board, move, 'X')
-                    send_board(conn, board)
-
-                    if check_victory(board, 'X'):
-                        send(conn, "Server wins!")
-                        display_board(board)
-                        print("You win!")
-                        break
-                    elif is_draw(board):
-                        send(conn, "Draw!")
-                        print("Draw!")
-                        break
-                    else:
-                        send(conn, "CONTINUE")
-
-except KeyboardInterrupt:
-    print("\nServer shut down manually.")
-except Exception as e:
-    print(f"Unexpected error: {e}")
\ No newline at end of file
+def parse_args(argv=None):
+    # parse_args([]) gives the default configuration, for the benchmarks.
+    parser = argparse.ArgumentParser(description="Tic-Tac-Toe GUI game server")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--level', choices=ai.LEVELS, default=ai.DEFAULT_LEVEL,
+                        help="server AI strength (normal is the classic heuristic)")
+    parser.add_argument('--delay', type=float, default=THINK_DELAY,
+                        help="seconds the server 'thinks' before each move (0 to disable)")
+    parser.add_argument('--benchmark', action='store_true',
+                        help="no thinking delay, no message rate limit and no per-game console output")
+    parser.add_argument('--move-timeout', type=float, default=MOVE_TIMEOUT,
+                        help="seconds a client has for each move")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker processes sharing the port via SO_REUSEPORT (0 = one per CPU)")
+    parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT,
+                        help="seconds to let running games finish on shutdown")
+    parser.add_argument('--max-size', type=int, default=MAX_SIZE,
+                        help=f"largest board a client may ask for (3-{MAX_SIZE})")
+    parser.add_argument('--search-budget', type=float, default=search.SEARCH_BUDGET,
+                        help="seconds the hard and perfect AI search on boards bigger than 3x3")
+    parser.add_argument('--search-workers', type=int, default=1,
+                        help="processes that run those searches (0 = one per CPU)")
+    parser.add_argument('--search-split', type=int, default=1,
+                        help="split each search's root moves into this many parallel tasks")
+    parser.add_argument('--slow-watchers', choices=SLOW_WATCHERS, default='latest',
+                        help="what a spectator that falls behind gets: only the latest board, or disconnected")
+    parser.add_argument('--max-sessions', type=int, default=0,
+                        help="players served at once per process (0 = no limit)")
+    parser.add_argument('--when-full', choices=WHEN_FULL, default='queue',
+                        help="what happens to a player beyond --max-sessions")
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+                        help="players that may wait for a free slot before new ones are rejected")
+    parser.add_argument('--backlog', type=int, default=BACKLOG, help="listen() backlog")
+    parser.add_argument('--rate', type=float, default=RATE,
+                        help="messages per second a player may send on average (0 = no limit)")
+    parser.add_argument('--burst', type=int, default=BURST,
+                        help="messages a player may send at once")
+    parser.add_argument('--write-limit', type=int, default=WRITE_LIMIT,
+                        help="unread reply bytes after which a player is disconnected")
+    parser.add_argument('--resume-ttl', type=float, default=RESUME_TTL,
+                        help="seconds a dropped player has to resume its game (0 = no resume tokens)")
+    parser.add_argument('--max-orphans', type=int, default=MAX_ORPHANS,
+                        help="dropped games kept for resuming; the oldest are given up first")
+    parser.add_argument('--journal', metavar='PATH',
+                        help="append every move to this binary journal (one file per worker with --workers)")
+    parser.add_argument('--ratings', metavar='PATH',
+                        help="keep named players' scores and ratings in this SQLite database")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help="serve Prometheus metrics on 127.0.0.1:PORT/metrics (0 to disable)")
+    args = parser.parse_args(argv)
+    if not 3 <= args.max_size <= MAX_SIZE:
+        parser.error(f"--max-size must be between 3 and {MAX_SIZE}")
+    if args.delay < 0:
+        parser.error("--delay must not be negative")
+    if not 0 < args.move_timeout < 65536:
+        parser.error("--move-timeout must be between 0 and 65535 seconds")
+    if args.search_budget <= 0:
+        parser.error("--search-budget must be positive")
+    if args.search_workers < 0:
+        parser.error("--search-workers must not be negative")
+    if args.search_split < 1:
+        parser.error("--search-split must be at least 1")
+    if args.max_sessions < 0 or args.queue_size < 0:
+        parser.error("--max-sessions and --queue-size must not be negative")
+    if args.rate < 0 or args.burst < 1:
+        parser.error("--rate must not be negative and --burst must be at least 1")
+    if args.backlog < 1 or args.write_limit < 1:
+        parser.error("--backlog and --write-limit must be positive")
+    if args.resume_ttl < 0 or args.max_orphans < 1:
+        parser.error("--resume-ttl must not be negative and --max-orphans must be at least 1")
+    if args.workers < 0:
+        parser.error("--workers must not be negative")
+    if args.workers != 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error("--workers needs SO_REUSEPORT, which this platform does not support")
+    if args.benchmark:
+        args.delay = 0.0
+        args.rate = 0.0
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    QUIET = args.benchmark
+    if args.level in ('hard', 'perfect'):
+        ai.load_tables()
+    try:
+        if args.workers == 1:
+            asyncio.run(serve(args))
+        else:
+            Supervisor(run_worker, (args,), count=args.workers, drain_timeout=args.drain_timeout,
+                       metrics_port=args.metrics_port).run()
+    except KeyboardInterrupt:
+        print("\nServer shut down manually.")
+    except Exception as e:
+        print(f"Unexpected error: {e}")
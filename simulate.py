@@ -0,0 +1,165 @@
+import argparse
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import ai
+import tablebase
+from engine import CELLS, LINES
+
+# Self-play on the 3x3 board without sockets: a batch of games is two arrays
+# of side masks, and every ply moves in all unfinished games at once.
+BITS = (1 << np.arange(CELLS)).astype(np.uint16)
+LINE_MASKS = np.array(LINES, dtype=np.uint16)
+T3 = np.array(ai.T3, dtype=np.int32)
+CENTER = 4
+CORNERS = np.array([0, 2, 6, 8])
+BATCH = 100000
+EPSILON = 0.1
+
+def covers_line(masks):
+    # True where a mask covers a full line; works on arrays of any shape.
+    return ((masks[..., None] & LINE_MASKS) == LINE_MASKS).any(axis=-1)
+
+# The same test for all 512 masks, so the hot path is one gather: wins(masks).
+WIN_TABLE = covers_line(np.arange(1 << CELLS, dtype=np.uint16))
+
+def wins(masks):
+    return WIN_TABLE[masks]
+
+def random_cell(allowed, rng):
+    # A uniformly random allowed cell index per row of an (n, 9) bool array.
+    scores = rng.random(allowed.shape)
+    scores[~allowed] = -1.0
+    return scores.argmax(axis=1)
+
+# Strategies mirror ai.find_best_move on 3x3. Each takes the side-to-move and
+# opponent masks of n games, their free cells as an (n, 9) bool array, the
+# random generator and the randomness rate, and returns n cell indices.
+
+def easy(me, opp, free, rng, epsilon):
+    return random_cell(free, rng)
+
+def normal(me, opp, free, rng, epsilon):
+    # ai.heuristic_move: sometimes random, else win, block, center, first
+    # free corner, random. Later rules override earlier ones here.
+    choice = random_cell(free, rng)
+    corners = free[:, CORNERS]
+    choice = np.where(corners.any(axis=1), CORNERS[corners.argmax(axis=1)], choice)
+    choice = np.where(free[:, CENTER], CENTER, choice)
+    for mask in (opp, me):
+        winning = wins(mask[:, None] | BITS) & free
+        choice = np.where(winning.any(axis=1), winning.argmax(axis=1), choice)
+    return np.where(rng.random(len(me)) < epsilon, random_cell(free, rng), choice)
+
+RECORDS = None
+
+def perfect(me, opp, free, rng, epsilon):
+    global RECORDS
+    if RECORDS is None:
+        ai.load_tables()
+        RECORDS = np.frombuffer(ai.TABLE, dtype='<u2', offset=tablebase.HEADER.size)
+    best = RECORDS[T3[me] + 2 * T3[opp]] & tablebase.MOVE_MASK
+    return random_cell((best[:, None] & BITS) != 0, rng)
+
+def hard(me, opp, free, rng, epsilon):
+    return np.where(rng.random(len(me)) < epsilon, normal(me, opp, free, rng, epsilon),
+                    perfect(me, opp, free, rng, epsilon))
+
+STRATEGIES = {'easy': easy, 'normal': normal, 'hard': hard, 'perfect': perfect}
+
+def play_batch(first, second, games, seed, epsilon=EPSILON):
+    # Returns (first player wins, second player wins, draws).
+    rng = np.random.default_rng(seed)
+    masks = (np.zeros(games, np.uint16), np.zeros(games, np.uint16))
+    strategies = (STRATEGIES[first], STRATEGIES[second])
+    results = np.zeros(games, np.int8)
+    active = np.arange(games)
+    for ply in range(CELLS):
+        side = ply & 1
+        me = masks[side][active]
+        opp = masks[1 - side][active]
+        free = ((me | opp)[:, None] & BITS) == 0
+        me |= BITS[strategies[side](me, opp, free, rng, epsilon)]
+        masks[side][active] = me
+        won = wins(me)
+        results[active[won]] = side + 1
+        active = active[~won]
+    first_wins, second_wins = np.bincount(results, minlength=3)[1:]
+    return int(first_wins), int(second_wins), games - int(first_wins) - int(second_wins)
+
+def run(args):
+    sizes = [args.batch] * (args.games // args.batch)
+    if args.games % args.batch:
+        sizes.append(args.games % args.batch)
+    seeds = np.random.SeedSequence(args.seed).spawn(len(sizes))
+    jobs = [(args.first, args.second, size, seed, args.epsilon) for size, seed in zip(sizes, seeds)]
+    started = time.perf_counter()
+    if args.processes == 1:
+        results = [play_batch(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(args.processes or None) as pool:
+            results = list(pool.map(play_batch, *zip(*jobs)))
+    return [sum(counts) for counts in zip(*results)], time.perf_counter() - started
+
+def summarize(counts, elapsed, args):
+    first_wins, second_wins, draws = counts
+    return {
+        'first': args.first,
+        'second': args.second,
+        'epsilon': args.epsilon,
+        'games': args.games,
+        'elapsed_s': round(elapsed, 3),
+        'games_per_s': round(args.games / elapsed, 1) if elapsed else 0.0,
+        'first_win_rate': round(first_wins / args.games, 4),
+        'second_win_rate': round(second_wins / args.games, 4),
+        'draw_rate': round(draws / args.games, 4),
+    }
+
+def print_report(summary):
+    print(f"Players:         {summary['first']} (first) vs {summary['second']} (second), "
+          f"epsilon {summary['epsilon']}")
+    print(f"Elapsed:         {summary['elapsed_s']:.2f} s")
+    print(f"Games:           {summary['games']} ({summary['games_per_s']:.1f} games/s)")
+    print(f"First wins:      {summary['first_win_rate']:.2%}")
+    print(f"Second wins:     {summary['second_win_rate']:.2%}")
+    print(f"Draws:           {summary['draw_rate']:.2%}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Batch self-play between the 3x3 AI strategies")
+    parser.add_argument('first', choices=STRATEGIES, help="strategy that moves first (the client)")
+    parser.add_argument('second', choices=STRATEGIES, help="strategy that moves second (the server)")
+    parser.add_argument('-n', '--games', type=int, default=1000000)
+    parser.add_argument('--batch', type=int, default=BATCH, help="games stepped together in one batch")
+    parser.add_argument('--epsilon', type=float, default=EPSILON,
+                        help="random-move rate of normal and heuristic-move rate of hard (the AI uses 0.1)")
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help="processes to spread the batches over (0 = one per CPU)")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', action='store_true', help="print the summary as JSON")
+    args = parser.parse_args()
+    if args.games < 1 or args.batch < 1:
+        parser.error("--games and --batch must be positive")
+    if not 0 <= args.epsilon <= 1:
+        parser.error("--epsilon must be between 0 and 1")
+    if args.processes < 0:
+        parser.error("--processes must not be negative")
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    if {'hard', 'perfect'} & {args.first, args.second}:
+        # Built once here rather than by every pool process.
+        ai.load_tables()
+    try:
+        counts, elapsed = run(args)
+    except KeyboardInterrupt:
+        print("\nSimulation stopped manually.")
+    else:
+        summary = summarize(counts, elapsed, args)
+        if args.json:
+            print(json.dumps(summary))
+        else:
+            print_report(summary)
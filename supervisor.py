@@ -0,0 +1,152 @@
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from collections import Counter
+
+import metrics
+
+RESTART_DELAY = 1.0
+STATS_INTERVAL = 10.0
+# Gauges like 'active' are meaningless once a worker is gone.
+GAUGES = tuple(key for key, (_, kind, _, _) in metrics.COUNTERS.items() if kind == 'gauge')
+
+class Supervisor:
+    # Pre-fork process manager: starts `count` copies of target(index, stats_queue, *args),
+    # restarts any that die, stops them with SIGTERM on shutdown and sums the
+    # stats and histogram snapshots they push onto the shared queue.
+    def __init__(self, target, args=(), count=None, drain_timeout=30.0, stats_interval=STATS_INTERVAL,
+                 metrics_port=0):
+        self.target = target
+        self.args = args
+        self.count = count or os.cpu_count() or 1
+        self.drain_timeout = drain_timeout
+        self.stats_interval = stats_interval
+        self.stats_queue = multiprocessing.Queue()
+        self.workers = [None] * self.count
+        self.started_at = [0.0] * self.count
+        self.metrics_port = metrics_port
+        self.latest = [Counter() for _ in range(self.count)]
+        self.latest_histograms = [{} for _ in range(self.count)]
+        self.retired = Counter()
+        self.retired_histograms = {}
+        self.restarts = 0
+        self.stopping = False
+        # The metrics thread reads what the main loop updates.
+        self.lock = threading.Lock()
+
+    def start_worker(self, index):
+        process = multiprocessing.Process(
+            target=self.target, args=(index, self.stats_queue) + tuple(self.args),
+            name=f"worker-{index}", daemon=False,
+        )
+        process.start()
+        self.workers[index] = process
+        self.started_at[index] = time.monotonic()
+        print(f"[supervisor] Started worker {index} (pid {process.pid})")
+
+    def retire_worker(self, index):
+        # Keep the counters of a dead worker so restarts don't lose history.
+        with self.lock:
+            stats = self.latest[index]
+            for key in GAUGES:
+                stats.pop(key, None)
+            self.retired.update(stats)
+            self.latest[index] = Counter()
+            merged = metrics.merge_snapshots([self.retired_histograms, self.latest_histograms[index]])
+            self.retired_histograms = metrics.snapshot_all(merged)
+            self.latest_histograms[index] = {}
+
+    def store_stats(self, item):
+        index, snapshot, histograms = item
+        with self.lock:
+            self.latest[index] = Counter(snapshot)
+            self.latest_histograms[index] = histograms
+
+    def collect_stats(self, timeout):
+        try:
+            self.store_stats(self.stats_queue.get(timeout=timeout))
+        except queue.Empty:
+            return
+        while True:
+            try:
+                self.store_stats(self.stats_queue.get_nowait())
+            except queue.Empty:
+                return
+
+    def combined_stats(self):
+        with self.lock:
+            total = Counter(self.retired)
+            for stats in self.latest:
+                total.update(stats)
+        total['workers'] = sum(1 for w in self.workers if w is not None and w.is_alive())
+        total['restarts'] = self.restarts
+        return total
+
+    def combined_histograms(self):
+        with self.lock:
+            return metrics.merge_snapshots([self.retired_histograms] + self.latest_histograms)
+
+    def collect_metrics(self):
+        return metrics.render(self.combined_stats(), self.combined_histograms())
+
+    def print_stats(self):
+        stats = self.combined_stats()
+        print("[supervisor] " + "  ".join(f"{key}={value}" for key, value in sorted(stats.items())))
+
+    def check_workers(self):
+        for index, process in enumerate(self.workers):
+            if process is None or process.is_alive():
+                continue
+            process.join()
+            self.retire_worker(index)
+            if self.stopping:
+                continue
+            print(f"[supervisor] Worker {index} (pid {process.pid}) exited with code {process.exitcode}, restarting")
+            self.restarts += 1
+            # Back off a little when a worker dies right after starting.
+            if time.monotonic() - self.started_at[index] < RESTART_DELAY:
+                time.sleep(RESTART_DELAY)
+            self.start_worker(index)
+
+    def request_stop(self, signum, frame):
+        self.stopping = True
+
+    def shutdown(self):
+        print(f"[supervisor] Draining {self.count} workers...")
+        for process in self.workers:
+            if process is not None and process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self.drain_timeout + 5.0
+        for process in self.workers:
+            if process is None:
+                continue
+            while process.is_alive() and time.monotonic() < deadline:
+                self.collect_stats(0.1)
+                process.join(0.1)
+            if process.is_alive():
+                print(f"[supervisor] Worker pid {process.pid} did not drain in time, killing it")
+                process.kill()
+                process.join()
+        self.collect_stats(0.2)
+        for index in range(self.count):
+            self.retire_worker(index)
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGTERM, self.request_stop)
+        if self.metrics_port:
+            metrics.start_server(self.metrics_port, self.collect_metrics)
+        for index in range(self.count):
+            self.start_worker(index)
+        last_report = time.monotonic()
+        while not self.stopping:
+            self.collect_stats(0.5)
+            self.check_workers()
+            if self.stats_interval and time.monotonic() - last_report >= self.stats_interval:
+                self.print_stats()
+                last_report = time.monotonic()
+        self.shutdown()
+        self.print_stats()
@@ -0,0 +1,69 @@
+import argparse
+import mmap
+import os
+import struct
+import time
+
+# A tablebase file is a header followed by one record per 3x3 position,
+# indexed by ai.position_key(me, opp) (the side to move first):
+#   header  magic, format version, number of records
+#   record  bits 0-8: the best moves as a cell mask (cell n in bit n - 1),
+#           bits 9-10: value for the side to move + 1 (0 lost, 1 draw, 2 won)
+# Unreachable and finished positions have no best moves. The file is mapped
+# read-only, so every worker process shares the same pages.
+MAGIC = b'TTTB'
+VERSION = 1
+HEADER = struct.Struct('<4sBI')
+RECORD = struct.Struct('<H')
+MOVE_MASK = 0x1FF
+VALUE_SHIFT = 9
+PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ai_table.bin')
+
+class TablebaseError(Exception):
+    pass
+
+def pack_record(best_moves, value):
+    return best_moves | (value + 1) << VALUE_SHIFT
+
+def write_table(records, path=PATH):
+    # Written to a temporary file first, so a running server never maps a
+    # half-written table.
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(records)))
+        f.write(b''.join(RECORD.pack(record) for record in records))
+    os.replace(tmp, path)
+
+def open_table(path, positions):
+    with open(path, 'rb') as f:
+        try:
+            table = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise TablebaseError(f"{path} is empty")
+    if len(table) < HEADER.size:
+        raise TablebaseError(f"{path} is truncated")
+    magic, version, count = HEADER.unpack_from(table)
+    if magic != MAGIC or version != VERSION:
+        raise TablebaseError(f"{path} is not a tablebase, or an unsupported version")
+    if count != positions or len(table) != HEADER.size + count * RECORD.size:
+        raise TablebaseError(f"{path} does not match this board")
+    return table
+
+def read_record(table, key):
+    # (best move mask, value) of position `key`.
+    record, = RECORD.unpack_from(table, HEADER.size + key * RECORD.size)
+    return record & MOVE_MASK, (record >> VALUE_SHIFT) - 1
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Solve 3x3 tic-tac-toe and write the AI tablebase")
+    parser.add_argument('-o', '--output', default=PATH)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    import ai
+    args = parse_args()
+    started = time.perf_counter()
+    records = ai.build_records()
+    write_table(records, args.output)
+    print(f"Wrote {args.output}: {len(records)} positions, {os.path.getsize(args.output)} bytes "
+          f"in {time.perf_counter() - started:.2f} s")